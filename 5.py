@@ -1,74 +1,84 @@
 import streamlit as st
 import sqlite3
 import os
-import uuid
 from datetime import datetime
-from PIL import Image
-import io
-import base64
-import pandas as pd
 from streamlit_geolocation import streamlit_geolocation
-# Configuration
-UPLOAD_FOLDER = 'Uploads'
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webm'}
+import threading
+import cache
+import db
+import dedupe
+import media
+import metrics
+import migrations
+import storage
+from config import UPLOAD_FOLDER, API_URL, MAX_FILE_SIZE
+from storage import save_file
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # Database setup
 # Initialize database
-def init_db():
-    conn = sqlite3.connect('heritage.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS heritage_sites (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            description TEXT,
-            category TEXT,
-            image_path TEXT,
-            audio_path TEXT,
-            latitude REAL,
-            longitude REAL,
-            timestamp TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+def init_db(conn):
+    migrations.migrate(conn)
 
-init_db()
+# Shared connections for every session in this process; the schema is only
+# checked the first time, not on each rerun
+@st.cache_resource
+def get_database():
+    database = db.get_database()
+    with database.writer() as conn:
+        init_db(conn)
+    return database
 
+database = get_database()
 
-# Check allowed file extensions
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Query results and upload bytes shared by all sessions, bounded in size
+@st.cache_resource
+def get_cache():
+    shared = cache.QueryCache()
+    metrics.register_gauge('sthalaspurti_query_cache_hits', "Query cache hits since start", lambda: shared.hits)
+    metrics.register_gauge('sthalaspurti_query_cache_misses', "Query cache misses since start", lambda: shared.misses)
+    metrics.register_gauge('sthalaspurti_query_cache_bytes', "Estimated query cache size", lambda: shared.size)
+    return shared
 
-# Save uploaded file
-def save_file(file, prefix):
+query_cache = get_cache()
+
+# Serve uploaded files; stored names never change content, so no version
+def get_file(path):
+    return query_cache.get(('file', path), lambda: cache.read_file(path))
+
+# Checked, downscaled preview of an uploaded photo and its perceptual hash.
+# Decoded once per distinct content rather than on every rerun of the form;
+# raises ValueError for files that are not the image they claim to be or are
+# too large.
+def photo_preview(photo):
+    ext = photo.name.rsplit('.', 1)[-1].lower()
+    key = ('preview', storage.file_digest(photo), ext)
+    return query_cache.get(key, lambda: media.make_preview(photo, ext))
+
+# created_at as a date, without pulling in pandas to parse it
+def format_date(value):
     try:
-        if file.size > MAX_FILE_SIZE:
-            return None, "File size exceeds 5MB limit"
-        ext = file.name.rsplit('.', 1)[1].lower() if '.' in file.name else ''
-        if not allowed_file(file.name):
-            return None, "Invalid file type. Use PNG, JPG, JPEG, GIF, or WebM"
-        filename = f"{prefix}_{uuid.uuid4()}.{ext}"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        with open(filepath, 'wb') as f:
-            f.write(file.read())
-        return filename, None
-    except Exception as e:
-        return None, f"Error saving file: {e}"
+        return datetime.fromisoformat(str(value)).strftime('%Y-%m-%d')
+    except ValueError:
+        return str(value)[:10]
+
 
 # Streamlit app
 st.set_page_config(page_title="Sthalaspurti - స్థలస్పూర్తి", layout="wide")
+# Sample this rerun's stacks when STHALASPURTI_PROFILE_DIR is set
+metrics.start_rerun_profile(st.session_state)
 st.title("Sthalaspurti - స్థలస్పూర్తి")
 st.subheader("Preserving Heritage, One Story at a Time")
 
-# Tabs
-tabs = st.tabs(["📸 Upload", "🗺️ Map", "🏛️ Gallery"])
-
 # Upload Tab
-with tabs[0]:
+@st.fragment
+@metrics.profiled()
+@metrics.timed('render')
+def upload_tab():
     st.header("Upload Heritage Site")
+    notice = st.session_state.pop('upload_notice', None)
+    if notice:
+        st.success(notice)
     st.subheader("📍 Get Current Location")
     
     # Call the component and get the result
@@ -89,8 +99,9 @@ with tabs[0]:
         # Image preview
         if photo:
             try:
-                img = Image.open(photo)
-                st.image(img, caption="Image Preview", use_column_width=True)
+                st.image(photo_preview(photo)[0], caption="Image Preview", use_column_width=True)
+            except ValueError as e:
+                st.error(str(e))
             except Exception as e:
                 st.error(f"Error displaying image preview: {e}")
         
@@ -212,6 +223,7 @@ with tabs[0]:
         </script>
         """, height=0)
         
+        allow_duplicate = st.checkbox("Share even if a similar site is already nearby")
         submitted = st.form_submit_button("✨ Share Heritage")
         if submitted:
             if not title or len(title) > 100:
@@ -220,47 +232,68 @@ with tabs[0]:
                 st.error("Description must be between 1 and 1000 characters")
             elif not photo:
                 st.error("Please upload an image")
-            elif not st.session_state.get("latitude") or not st.session_state.get("longitude"):
-                st.error("Please get location")
+            elif not latitude.strip() or not longitude.strip():
+                st.error("Please get location or enter latitude and longitude")
             else:
                 try:
-                    # Save image
-                    image_filename, image_error = save_file(photo, 'image')
+                    # Location from the form fields, which the fetch button fills in
+                    try:
+                        lat, lng = float(latitude), float(longitude)
+                    except ValueError:
+                        st.error("Latitude and longitude must be numbers")
+                        st.stop()
+                    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                        st.error("Location out of range")
+                        st.stop()
+                    # Save image, refusing anything the preview step rejected
+                    try:
+                        _, phash = photo_preview(photo)
+                    except ValueError as e:
+                        st.error(str(e))
+                        st.stop()
+                    
+                    # Warn before adding another entry for a place already shared
+                    if not allow_duplicate:
+                        with database.reader() as conn:
+                            duplicates = dedupe.find_duplicates(conn, lat, lng, phash)
+                        if duplicates:
+                            nearby = ', '.join(f"{d['title']} ({d['distance_m']} m away)" for d in duplicates)
+                            st.warning(f"This looks like a site already shared: {nearby}. "
+                                       "Tick the box above to share it anyway.")
+                            st.stop()
+                    
+                    image_filename, image_error = save_file(photo)
                     if image_error:
                         st.error(image_error)
                         st.stop()
+                    media.submit_derivatives(image_filename)
                     
                     # Save audio
                     audio_filename = None
                     audio_data = st.session_state.get('audioBlob', '')
                     if audio_data and audio_data.startswith('data:audio/webm;base64,'):
-                        audio_data = audio_data.replace('data:audio/webm;base64,', '')
-                        audio_bytes = base64.b64decode(audio_data)
-                        audio_filename = f"audio_{uuid.uuid4()}.webm"
-                        with open(os.path.join(UPLOAD_FOLDER, audio_filename), 'wb') as f:
-                            f.write(audio_bytes)
+                        audio_filename, _ = storage.store_data_url(audio_data, 'webm', max_size=MAX_FILE_SIZE)
                     
                     # Save to database
-                    conn = sqlite3.connect('heritage.db')
-                    c = conn.cursor()
-                    c.execute('INSERT INTO sites (title, description, category, lat, lng, image, audio) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                             (title, description, category, st.session_state.geolocation['lat'],
-                              st.session_state.geolocation['lng'], image_filename, audio_filename))
-                    conn.commit()
-                    conn.close()
-                    st.success("Heritage site uploaded successfully!")
+                    with database.writer() as conn:
+                        db.insert_site(conn, title, description, category,
+                                       lat, lng, image_filename, audio_filename)
+                        dedupe.store_hash(conn, image_filename, phash)
                     st.session_state.geolocation = {'lat': None, 'lng': None}
                     st.session_state.lat = ''
                     st.session_state.lng = ''
                     st.session_state.audioBlob = ''
+                    # Rerun the whole app so the Gallery shows the new site
+                    st.session_state['upload_notice'] = "Heritage site uploaded successfully!"
+                    st.rerun()
                 except sqlite3.Error as e:
                     st.error(f"Database error: {e}")
                 except Exception as e:
                     st.error(f"Error: {e}")
 
-# Map Tab
-with tabs[1]:
-    st.header("Heritage Map / వారసత్వ మ్యాప్")
+# Map page, built once per process
+@st.cache_resource
+def get_map_html():
     map_html = """
     <div id="map" style="height: 500px; border-radius: 15px;"></div>
     <button id="toggleMapBtn" class="btn">Toggle 2D/3D View</button>
@@ -276,9 +309,20 @@ with tabs[1]:
             border-radius: 10px; cursor: pointer; margin-bottom: 10px;
         }
         .btn:hover { transform: translateY(-2px); }
+        .cluster {
+            width: 48px; height: 48px; border-radius: 50%;
+            background-size: cover; background-position: center;
+            border: 3px solid #764ba2; box-shadow: 0 2px 6px rgba(0, 0, 0, 0.4);
+            display: flex; align-items: flex-end; justify-content: flex-end;
+        }
+        .cluster span {
+            background: #667eea; color: white; font-weight: bold;
+            border-radius: 10px; padding: 0 6px; font-size: 12px;
+        }
     </style>
     <script>
-        let map, cesiumViewer, is3DView = false;
+        const API_URL = '__API_URL__';
+        let map, siteLayer, cesiumViewer, is3DView = false;
         function initMap() {
             map = L.map('map').setView([17.3850, 78.4867], 10);
             const osmLayer = L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
@@ -294,21 +338,69 @@ with tabs[1]:
             osmLayer.addTo(map);
             L.control.layers(baseLayers).addTo(map);
             
-            fetch('/sites')
-            .then(response => response.json())
-            .then(sites => {
-                sites.forEach(site => {
-                    if (site.lat && site.lng) {
-                        L.marker([site.lat, site.lng])
-                        .bindPopup(`
-                            <div style="max-width: 200px;">
-                                <img src="/Uploads/${site.image}" style="width: 100%; height: 80px; object-fit: cover;">
-                                <h4>${site.title}</h4>
-                                <p>${site.description.substring(0, 50)}...</p>
-                                ${site.audio ? `<audio controls src="/Uploads/${site.audio}"></audio>` : ''}
-                            </div>
-                        `)
-                        .addTo(map);
+            siteLayer = L.layerGroup().addTo(map);
+            map.on('moveend', loadLeafletSites);
+            loadLeafletSites();
+        }
+        
+        // Map tiles (z/x/y) covering a bounding box
+        function tilesFor(west, south, east, north, zoom) {
+            const n = 2 ** zoom;
+            const clamp = v => Math.min(n - 1, Math.max(0, Math.floor(v)));
+            const tileX = lng => clamp((lng + 180) / 360 * n);
+            const tileY = lat => {
+                const r = Math.max(-85.0511, Math.min(85.0511, lat)) * Math.PI / 180;
+                return clamp((1 - Math.log(Math.tan(r) + 1 / Math.cos(r)) / Math.PI) / 2 * n);
+            };
+            const tiles = [];
+            for (let x = tileX(west); x <= tileX(east); x++) {
+                for (let y = tileY(north); y <= tileY(south); y++) {
+                    tiles.push(`${zoom}/${x}/${y}`);
+                }
+            }
+            return tiles;
+        }
+        
+        // Clusters and single sites for a set of tiles; at most 16 per tile
+        function loadTiles(tiles) {
+            return Promise.all(tiles.map(tile =>
+                fetch(`${API_URL}/tiles/${tile}.json`).then(response => response.json())
+            )).then(results => results.flat());
+        }
+        
+        function popupHtml(site) {
+            return `
+                <div style="max-width: 200px;">
+                    <img src="${API_URL}/Uploads/${site.image}?size=200" style="width: 100%; height: 80px; object-fit: cover;">
+                    <h4>${site.title}</h4>
+                    <p>${site.description.substring(0, 50)}...</p>
+                    ${site.audio ? `<audio controls src="${API_URL}/Uploads/${site.audio}"></audio>` : ''}
+                </div>
+            `;
+        }
+        
+        let leafletRequest = 0;
+        function loadLeafletSites() {
+            const bounds = map.getBounds();
+            const zoom = Math.round(map.getZoom());
+            const request = ++leafletRequest;
+            loadTiles(tilesFor(bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth(), zoom))
+            .then(features => {
+                if (request !== leafletRequest) return;  // a newer view is loading
+                siteLayer.clearLayers();
+                features.forEach(site => {
+                    if (site.count > 1) {
+                        L.marker([site.lat, site.lng], {
+                            icon: L.divIcon({
+                                className: '',
+                                html: `<div class="cluster" style="background-image: url(${API_URL}/Uploads/${site.image}?size=64);"><span>${site.count}</span></div>`,
+                                iconSize: [48, 48]
+                            })
+                        })
+                        .on('click', () => map.setView([site.lat, site.lng], Math.min(zoom + 2, map.getMaxZoom())))
+                        .addTo(siteLayer);
+                    } else {
+                        L.marker([site.lat, site.lng]).bindPopup(popupHtml(site)).addTo(siteLayer);
                     }
                 });
             })
@@ -323,39 +415,69 @@ with tabs[1]:
                 baseLayerPicker: true
             });
             
-            fetch('/sites')
-            .then(response => response.json())
-            .then(sites => {
-                sites.forEach(site => {
-                    if (site.lat && site.lng) {
+            cesiumViewer.camera.moveEnd.addEventListener(loadCesiumSites);
+            loadCesiumSites();
+        }
+        
+        let cesiumRequest = 0;
+        function loadCesiumSites() {
+            const rect = cesiumViewer.camera.computeViewRectangle();
+            let tiles = tilesFor(-180, -85, 180, 85, 2);
+            if (rect) {
+                const deg = Cesium.Math.toDegrees;
+                const [west, south, east, north] = [deg(rect.west), deg(rect.south), deg(rect.east), deg(rect.north)];
+                const width = ((east - west) + 360) % 360 || 360;
+                const zoom = Math.max(0, Math.min(22, Math.round(Math.log2(360 / width)) + 2));
+                tiles = west <= east
+                    ? tilesFor(west, south, east, north, zoom)
+                    : tilesFor(west, south, 180, north, zoom).concat(tilesFor(-180, south, east, north, zoom));
+            }
+            const request = ++cesiumRequest;
+            loadTiles(tiles)
+            .then(features => {
+                if (request !== cesiumRequest) return;
+                cesiumViewer.entities.removeAll();
+                features.forEach(site => {
+                    const position = Cesium.Cartesian3.fromDegrees(site.lng, site.lat, 100);
+                    if (site.count > 1) {
                         cesiumViewer.entities.add({
-                            position: Cesium.Cartesian3.fromDegrees(site.lng, site.lat, 100),
+                            position: position,
                             billboard: {
-                                image: '/Uploads/' + site.image,
-                                width: 64,
-                                height: 64
+                                image: `${API_URL}/Uploads/${site.image}?size=64`,
+                                width: 48,
+                                height: 48
                             },
                             label: {
-                                text: site.title,
-                                font: '14pt Arial',
+                                text: String(site.count),
+                                font: 'bold 16pt Arial',
                                 fillColor: Cesium.Color.WHITE,
                                 outlineColor: Cesium.Color.BLACK,
-                                style: Cesium.LabelStyle.FILL_AND_OUTLINE,
-                                verticalOrigin: Cesium.VerticalOrigin.BOTTOM,
-                                pixelOffset: new Cesium.Cartesian2(0, -70)
-                            },
-                            description: `
-                                <div style="max-width: 200px;">
-                                    <img src="/Uploads/${site.image}" style="width: 100%; height: 80px; object-fit: cover;">
-                                    <h4>${site.title}</h4>
-                                    <p>${site.description.substring(0, 50)}...</p>
-                                    ${site.audio ? `<audio controls src="/Uploads/${site.audio}"></audio>` : ''}
-                                </div>
-                            `
+                                style: Cesium.LabelStyle.FILL_AND_OUTLINE
+                            }
                         });
+                        return;
                     }
+                    cesiumViewer.entities.add({
+                        position: position,
+                        billboard: {
+                            image: `${API_URL}/Uploads/${site.image}?size=64`,
+                            width: 64,
+                            height: 64
+                        },
+                        label: {
+                            text: site.title,
+                            font: '14pt Arial',
+                            fillColor: Cesium.Color.WHITE,
+                            outlineColor: Cesium.Color.BLACK,
+                            style: Cesium.LabelStyle.FILL_AND_OUTLINE,
+                            verticalOrigin: Cesium.VerticalOrigin.BOTTOM,
+                            pixelOffset: new Cesium.Cartesian2(0, -70)
+                        },
+                        description: popupHtml(site)
+                    });
                 });
-            });
+            })
+            .catch(error => console.error('Error loading sites:', error));
         }
         
         function toggleMapView() {
@@ -372,70 +494,91 @@ with tabs[1]:
         });
     </script>
     """
-    st.components.v1.html(map_html, height=600)
+    return map_html.replace('__API_URL__', API_URL)
+
+# Map Tab
+@st.fragment
+@metrics.profiled()
+@metrics.timed('render')
+def map_tab():
+    st.header("Heritage Map / వారసత్వ మ్యాప్")
+    st.components.v1.html(get_map_html(), height=600)
 
 # Gallery Tab
-with tabs[2]:
+@st.fragment
+@metrics.profiled()
+@metrics.timed('render')
+def gallery_tab():
     st.header("Heritage Gallery / వారసత్వ గ్యాలరీ")
-    search = st.text_input("Search by title or category...")
+    search = st.text_input("Search by title, description or category...")
     
     try:
-        conn = sqlite3.connect('heritage.db')
-        sites = pd.read_sql_query('SELECT * FROM sites ORDER BY created_at DESC', conn)
-        conn.close()
-        
-        if search:
-            sites = sites[sites['title'].str.lower().str.contains(search.lower()) |
-                          sites['category'].str.lower().str.contains(search.lower())]
-        
+        version = database.version
         items_per_page = 6
-        total_pages = max(1, (len(sites) + items_per_page - 1) // items_per_page)
-        page = st.number_input("Page", min_value=1, max_value=total_pages, value=1, step=1)
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
-        paginated_sites = sites[start:end]
-        
-        for _, site in paginated_sites.iterrows():
-            st.markdown(f"### {site['title']}")
+        with database.reader() as conn:
+            if search:
+                total = query_cache.get(('search_count', search),
+                                        lambda: db.count_search(conn, search), version)
+            else:
+                total = query_cache.get(('count',), lambda: db.count_sites(conn), version)
+            total_pages = max(1, (total + items_per_page - 1) // items_per_page)
+            page = st.number_input("Page", min_value=1, max_value=total_pages, value=1, step=1)
+            offset = (page - 1) * items_per_page
+
+            if search:
+                # Ranked by relevance, so pages are addressed by offset into the matches
+                paginated_sites = query_cache.get(
+                    ('search', search, offset),
+                    lambda: db.search_sites(conn, search, limit=items_per_page, offset=offset), version)
+            else:
+                # Remember where each page ended so the next one is a keyset seek
+                cursors = st.session_state.setdefault('gallery_cursors', {})
+                after = cursors.get(page - 1)
+                paginated_sites = query_cache.get(
+                    ('page', after, offset),
+                    lambda: db.fetch_sites_page(conn, after=after, limit=items_per_page, offset=offset),
+                    version)
+                cursors[page] = db.page_cursor(paginated_sites)
+
+        for site in paginated_sites:
+            st.markdown(f"### {site['title_match'] if search else site['title']}")
             col1, col2 = st.columns([1, 2])
             with col1:
                 try:
-                    image_path = os.path.join("uploads", site['image'])  # NOT UPLOAD_FOLDER directly
-                    st.image(image_path, use_container_width=True)
+                    image_path = media.image_path(site['image'], 800)
+                    st.image(get_file(image_path), use_container_width=True)
                 except:
                     st.error("Image not found")
             with col2:
-                st.write(f"**Description**: {site['description']}")
+                st.write(f"**Description**: {site['description_match'] if search else site['description']}")
                 st.write(f"**Category**: {site['category']}")
-                st.write(f"**Date**: {pd.to_datetime(site['created_at']).strftime('%Y-%m-%d')}")
+                st.write(f"**Date**: {format_date(site['created_at'])}")
                 if site['audio']:
                     try:
-                        st.audio(os.path.join(UPLOAD_FOLDER, site['audio']))
+                        st.audio(get_file(os.path.join(UPLOAD_FOLDER, site['audio'])), format='audio/webm')
                     except:
                         st.error("Audio not found")
     except sqlite3.Error as e:
         st.error(f"Database error: {e}")
 
-# Serve uploaded files
-@st.cache_data
-def get_file(filename):
-    try:
-        with open(os.path.join(UPLOAD_FOLDER, filename), 'rb') as f:
-            return f.read()
-    except FileNotFoundError:
-        return None
+# Tabs. Each one is a fragment, so interacting with a tab reruns only that
+# tab; the whole app reruns on first load and after an upload.
+tabs = st.tabs(["📸 Upload", "🗺️ Map", "🏛️ Gallery"])
+with tabs[0]:
+    upload_tab()
+with tabs[1]:
+    map_tab()
+with tabs[2]:
+    gallery_tab()
 
-# Expose /Uploads endpoint for map popups
+# Expose /sites and /Uploads for the map, once per Streamlit process. Flask is
+# only imported here, so it stays off the script's import path.
+@st.cache_resource
+def start_api_server():
+    import server
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    return thread
 
-    from flask import Flask, send_from_directory
-    flask_app = Flask(__name__)
-    
-    @flask_app.route('/Uploads/<filename>')
-    def uploaded_file(filename):
-        try:
-            return send_from_directory(UPLOAD_FOLDER, filename)
-        except FileNotFoundError:
-            return {"success": False, "message": "File not found"}, 404
-    
-    if __name__ == '__main__':
-        flask_app.run(port=5001)
+start_api_server()
+metrics.finish_rerun_profile(st.session_state)
@@ -0,0 +1,312 @@
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from PIL import Image, ImageDraw
+import cache
+import clusters
+import db
+import media
+import migrations
+import storage
+
+# Benchmarks for the app's hot paths against a synthetic dataset.
+#   python bench.py --sites 100000 --output bench.json
+# The dataset is generated deterministically from --seed in a scratch
+# directory (its own heritage.db and Uploads/), so runs are comparable and
+# the real data is never touched. Results are JSON: p50/p95/p99 latency in
+# milliseconds, throughput and, per operation, the resident memory it started
+# from and how far above that it peaked.
+CENTER = (17.3850, 78.4867)  # Hyderabad, the map's default view
+CATEGORIES = ['temple', 'monument', 'sacred tree', 'well', 'statue', 'market', 'other']
+TELUGU_WORDS = ['దేవాలయం', 'బావి', 'చెట్టు', 'విగ్రహం', 'మార్కెట్', 'స్మారక', 'చరిత్ర', 'కథ',
+                'పురాతన', 'గ్రామం', 'రాజు', 'శిల్పం', 'కోట', 'గుడి', 'పండుగ', 'నది']
+ENGLISH_WORDS = ['temple', 'well', 'tree', 'statue', 'market', 'fort', 'story', 'ancient',
+                 'village', 'king', 'carving', 'festival', 'river', 'stepwell', 'shrine', 'gate']
+INSERT_BATCH = 5000
+
+
+class FakeUpload(io.BytesIO):
+    # The parts of Streamlit's UploadedFile that save_file() uses
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(TELUGU_WORDS if rng.random() < 0.5 else ENGLISH_WORDS)
+                    for _ in range(count))
+
+
+def _location(rng):
+    # Most sites cluster around the city, the rest spread over the region
+    if rng.random() < 0.8:
+        return rng.gauss(CENTER[0], 0.15), rng.gauss(CENTER[1], 0.15)
+    return CENTER[0] + rng.uniform(-2, 2), CENTER[1] + rng.uniform(-2, 2)
+
+
+def make_image(rng, width=640, height=480):
+    img = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle([x, y, x + rng.randrange(20, 200), y + rng.randrange(20, 200)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+def make_audio(rng):
+    # EBML magic followed by noise; the app only stores and serves audio
+    return b'\x1a\x45\xdf\xa3' + rng.randbytes(rng.randrange(16_000, 48_000))
+
+
+def generate_sites(rng, count, images, audio):
+    for _ in range(count):
+        lat, lng = _location(rng)
+        yield (_words(rng, rng.randrange(2, 5)), _words(rng, rng.randrange(10, 40)),
+               rng.choice(CATEGORIES), lat, lng, rng.choice(images),
+               rng.choice(audio) if rng.random() < 0.3 else None,
+               f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d} "
+               f"{rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}")
+
+
+def _proc_status_kb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_kb():
+    peak = _proc_status_kb('VmHWM')
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+# Resident memory now and, where the kernel allows resetting the high-water
+# mark (Linux), the baseline the next peak is measured from. Elsewhere the
+# baseline is the process peak so far, and the delta only shows how far an
+# operation pushed it up.
+def rss_baseline_kb():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return peak_rss_kb()
+    return _proc_status_kb('VmRSS')
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def measure(operation, iterations):
+    timings, sizes = [], []
+    baseline = rss_baseline_kb()
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        size = operation(i)
+        timings.append((time.perf_counter() - t0) * 1000)
+        if size is not None:
+            sizes.append(size)
+    elapsed = time.perf_counter() - start
+    ordered = sorted(timings)
+    result = {
+        'iterations': iterations,
+        'p50_ms': round(_percentile(ordered, 0.50), 3),
+        'p95_ms': round(_percentile(ordered, 0.95), 3),
+        'p99_ms': round(_percentile(ordered, 0.99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'ops_per_s': round(iterations / elapsed, 1),
+        'rss_baseline_kb': baseline,
+        'peak_rss_delta_kb': max(0, peak_rss_kb() - baseline),
+    }
+    if sizes:
+        result['mean_bytes'] = round(sum(sizes) / len(sizes))
+    return result
+
+
+def _viewport(rng, zoom, width=1024, height=768):
+    lat, lng = _location(rng)
+    half_w = width / 2 / 256 / 2 ** zoom * 360
+    half_h = half_w * height / width
+    return lng - half_w, lat - half_h, lng + half_w, lat + half_h
+
+
+# Fill the scratch database and upload store
+def populate(args, rng):
+    start = time.perf_counter()
+    images, audio = [], []
+    for _ in range(args.media):
+        path, _ = storage.store_chunks([make_image(rng)], 'jpg')
+        media.make_derivatives(path)
+        images.append(path)
+    for _ in range(max(1, args.media // 4)):
+        audio.append(storage.store_chunks([make_audio(rng)], 'webm')[0])
+    media_seconds = time.perf_counter() - start
+
+    conn = db.connect()
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrations.migrate(conn)
+    start = time.perf_counter()
+    sites = generate_sites(rng, args.sites, images, audio)
+    while True:
+        batch = [site for _, site in zip(range(INSERT_BATCH), sites)]
+        if not batch:
+            break
+        with conn:
+            conn.executemany('INSERT INTO sites (title, description, category, lat, lng, image, audio, created_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', batch)
+    insert_seconds = time.perf_counter() - start
+    conn.close()
+    return images, audio, {
+        'media_files': len(images) + len(audio),
+        'media_seconds': round(media_seconds, 2),
+        'insert_seconds': round(insert_seconds, 2),
+        'inserts_per_s': round(args.sites / insert_seconds) if insert_seconds else None,
+        'db_bytes': os.path.getsize(db.DB_PATH),
+    }
+
+
+def run(args):
+    # server resolves the upload folder when imported, so only after the
+    # scratch directory is the working directory
+    import server
+
+    rng = random.Random(args.seed)
+    images, audio, setup = populate(args, rng)
+    database = db.get_database()
+    client = server.flask_app.test_client()
+    results = {}
+
+    # Upload form: save_file() into the store, then the site insert. Photos
+    # are generated up front so only the app's work is timed.
+    photos = [make_image(rng, 1600, 1200) for _ in range(args.iterations)]
+
+    def upload(i):
+        photo = FakeUpload(photos[i], f"photo_{i}.jpg")
+        image, error = storage.save_file(photo)
+        if error:
+            raise RuntimeError(error)
+        lat, lng = _location(rng)
+        with database.writer() as conn:
+            db.insert_site(conn, _words(rng, 3), _words(rng, 20), rng.choice(CATEGORIES),
+                           lat, lng, image, None)
+        return photo.size
+    results['upload'] = measure(upload, args.iterations)
+
+    # Gallery data path: count, walk pages by keyset, read each card's image
+    # bytes. Streamlit's rendering of the cards is not included.
+    cursor = [None]
+
+    def gallery_page(i):
+        with database.reader() as conn:
+            db.count_sites(conn)
+            rows = db.fetch_sites_page(conn, after=cursor[0], limit=6)
+        cursor[0] = db.page_cursor(rows) if i % 50 != 49 else None
+        size = 0
+        for row in rows:
+            size += len(cache.read_file(media.image_path(row['image'], 800)))
+        return size
+    results['gallery_page'] = measure(gallery_page, args.iterations)
+
+    def gallery_jump(i):
+        with database.reader() as conn:
+            pages = max(1, db.count_sites(conn) // 6)
+            db.fetch_sites_page(conn, limit=6, offset=rng.randrange(min(pages, 1000)) * 6)
+    results['gallery_jump'] = measure(gallery_jump, args.iterations)
+
+    def search(i):
+        word = rng.choice(TELUGU_WORDS + ENGLISH_WORDS)
+        text = word[:rng.randrange(2, len(word) + 1)]
+        with database.reader() as conn:
+            db.count_search(conn, text)
+            db.search_sites(conn, text, limit=6)
+    results['search'] = measure(search, args.iterations)
+
+    def sites_api(i):
+        zoom = rng.randrange(10, 17)
+        bbox = ','.join(f"{v:.5f}" for v in _viewport(rng, zoom))
+        response = client.get(f"/sites?bbox={bbox}&zoom={zoom}&limit=500")
+        return len(response.data)
+    results['sites_api'] = measure(sites_api, args.iterations)
+
+    def map_tiles(i):
+        zoom = rng.randrange(8, 17)
+        west, south, east, north = _viewport(rng, zoom)
+        x0, y1 = (int(v * 2 ** zoom) for v in clusters.project(south, west))
+        x1, y0 = (int(v * 2 ** zoom) for v in clusters.project(north, east))
+        size = 0
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                size += len(client.get(f"/tiles/{zoom}/{x}/{y}.json").data)
+        return size
+    results['map_tiles'] = measure(map_tiles, args.iterations)
+
+    def uploads_serve(i):
+        response = client.get(f"/Uploads/{rng.choice(images)}?size=200")
+        return len(response.data)
+    results['uploads_serve'] = measure(uploads_serve, args.iterations)
+
+    def uploads_audio_range(i):
+        response = client.get(f"/Uploads/{rng.choice(audio)}", headers={'Range': 'bytes=0-16383'})
+        return len(response.data)
+    results['uploads_audio_range'] = measure(uploads_audio_range, args.iterations)
+
+    return setup, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Sthalaspurti against synthetic data")
+    parser.add_argument('--sites', type=int, default=1000, help="sites to generate (1k to 1M)")
+    parser.add_argument('--iterations', type=int, default=200, help="timed runs per operation")
+    parser.add_argument('--media', type=int, default=100, help="distinct generated images")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help="scratch directory, kept afterwards (default: temporary)")
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    here = os.getcwd()
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sthalaspurti-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    try:
+        setup, results = run(args)
+    finally:
+        os.chdir(here)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'config': {'sites': args.sites, 'iterations': args.iterations, 'media': args.media,
+                   'seed': args.seed, 'python': sys.version.split()[0]},
+        'setup': setup,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+import metrics
+
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+# Rough in-memory footprint of a cached value, good enough for the budget
+def _sizeof(value):
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value) + 64
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(item) for item in value) + 64
+    if hasattr(value, 'keys'):
+        return sum(_sizeof(value[key]) for key in value.keys()) + 64
+    return 64
+
+
+# LRU cache with a memory budget. Query results are stored against the data
+# version they were read at, so a write makes them miss without any explicit
+# invalidation; file bytes are keyed by their immutable path alone.
+class QueryCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, version=None):
+        key = (version, key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value = compute()
+        self._put(key, value)
+        return value
+
+    def _put(self, key, value):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+@metrics.timed('file')
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
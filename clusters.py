@@ -0,0 +1,214 @@
+import math
+import sqlite3
+import db
+import metrics
+
+# Precomputed cluster pyramid for the map.
+# Every zoom level up to MAX_CLUSTER_ZOOM is cut into square grid cells
+# CELL_PX screen pixels wide (Web Mercator, 256px tiles). Each cell keeps a
+# count, the coordinate sums for its centroid and its newest site, which
+# stands in as the cluster's thumbnail. A map tile therefore never holds more
+# than (256 / CELL_PX) ** 2 features, however many sites fall inside it.
+MAX_CLUSTER_ZOOM = 16
+CELL_PX = 64
+CELLS_PER_TILE = 256 // CELL_PX
+MAX_LAT = 85.05112878
+# Largest coordinate on the unit square, so the east and south edges fall in
+# the last cell rather than one past it
+MAX_UNIT = 1.0 - 1e-12
+# SQLite with the built-in math functions the cell expressions below need
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+# project() in SQL, scaled to cells at MAX_CLUSTER_ZOOM. Plain SQL keeps the
+# triggers usable from any SQLite client, not just connections made here.
+def _cell_x_sql(lng):
+    return (f'CAST(min(max(({lng} + 180.0) / 360.0, 0.0), {MAX_UNIT!r})'
+            f' * {CELLS_PER_TILE << MAX_CLUSTER_ZOOM} AS INTEGER)')
+
+
+def _cell_y_sql(lat):
+    sin_lat = f'sin(radians(min(max({lat}, -{MAX_LAT}), {MAX_LAT})))'
+    return (f'CAST(min(max(0.5 - ln((1 + {sin_lat}) / (1 - {sin_lat})) / (4 * pi()), 0.0), {MAX_UNIT!r})'
+            f' * {CELLS_PER_TILE << MAX_CLUSTER_ZOOM} AS INTEGER)')
+
+CLUSTER_SCHEMA = '''
+    CREATE TABLE site_clusters (
+        zoom INTEGER, cx INTEGER, cy INTEGER,
+        count INTEGER, sum_lat REAL, sum_lng REAL, site_id INTEGER,
+        PRIMARY KEY (zoom, cx, cy)
+    ) WITHOUT ROWID
+'''
+
+_UPSERT = '''
+    ON CONFLICT (zoom, cx, cy) DO UPDATE SET
+        count = count + excluded.count,
+        sum_lat = sum_lat + excluded.sum_lat,
+        sum_lng = sum_lng + excluded.sum_lng,
+        site_id = max(site_id, excluded.site_id)
+'''
+
+# Each site's cell at MAX_CLUSTER_ZOOM. Cells nest, so its cell at zoom z is
+# (cx, cy) >> (MAX_CLUSTER_ZOOM - z), and every site in a coarser cell is a
+# range scan of idx_site_cells_cell away.
+SUPPORT_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS cluster_zooms (zoom INTEGER PRIMARY KEY);
+    INSERT OR IGNORE INTO cluster_zooms (zoom) VALUES {zooms};
+    CREATE TABLE IF NOT EXISTS site_cells
+        (site_id INTEGER PRIMARY KEY, cx INTEGER NOT NULL, cy INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_site_cells_cell ON site_cells (cx, cy);
+'''.format(zooms=', '.join(f'({z})' for z in range(MAX_CLUSTER_ZOOM + 1)))
+
+# Cells of site {site} at every zoom, while its site_cells row exists
+_SITE_CELLS = '''
+    SELECT z.zoom, c.cx >> ({max_zoom} - z.zoom), c.cy >> ({max_zoom} - z.zoom)
+    FROM cluster_zooms z, site_cells c WHERE c.site_id = {site}.id
+'''
+
+# Take a site out of its cells. Emptied cells go; a cell whose newest site
+# this was gets the next newest one still in it.
+_REMOVE_SITE = '''
+    UPDATE site_clusters SET count = count - 1, sum_lat = sum_lat - {site}.lat,
+                             sum_lng = sum_lng - {site}.lng
+    WHERE (zoom, cx, cy) IN ({cells});
+    DELETE FROM site_clusters WHERE count <= 0 AND (zoom, cx, cy) IN ({cells});
+    UPDATE site_clusters SET site_id = (
+        SELECT MAX(c.site_id) FROM site_cells c
+        WHERE c.cx BETWEEN site_clusters.cx << ({max_zoom} - site_clusters.zoom)
+                       AND ((site_clusters.cx + 1) << ({max_zoom} - site_clusters.zoom)) - 1
+          AND c.cy BETWEEN site_clusters.cy << ({max_zoom} - site_clusters.zoom)
+                       AND ((site_clusters.cy + 1) << ({max_zoom} - site_clusters.zoom)) - 1
+          AND c.site_id <> {site}.id)
+    WHERE site_id = {site}.id AND (zoom, cx, cy) IN ({cells});
+    DELETE FROM site_cells WHERE site_id = {site}.id;
+'''
+
+_ADD_SITE = '''
+    INSERT INTO site_cells (site_id, cx, cy)
+    SELECT {site}.id, {cell_x}, {cell_y}
+    WHERE {site}.lat IS NOT NULL AND {site}.lng IS NOT NULL;
+    INSERT INTO site_clusters (zoom, cx, cy, count, sum_lat, sum_lng, site_id)
+    SELECT cell.*, 1, {site}.lat, {site}.lng, {site}.id FROM ({cells}) AS cell WHERE true
+    {upsert};
+'''
+
+
+def _for(template, site):
+    cells = _SITE_CELLS.format(max_zoom=MAX_CLUSTER_ZOOM, site=site)
+    return template.format(max_zoom=MAX_CLUSTER_ZOOM, site=site, cells=cells, upsert=_UPSERT,
+                           cell_x=_cell_x_sql(f'{site}.lng'), cell_y=_cell_y_sql(f'{site}.lat'))
+
+
+# Keep the pyramid in step with sites, like the other derived tables
+TRIGGERS_SCHEMA = f'''
+    CREATE TRIGGER site_clusters_ai AFTER INSERT ON sites BEGIN
+        {_for(_ADD_SITE, 'new')}
+    END;
+    CREATE TRIGGER site_clusters_ad AFTER DELETE ON sites BEGIN
+        {_for(_REMOVE_SITE, 'old')}
+    END;
+    CREATE TRIGGER site_clusters_au AFTER UPDATE OF lat, lng ON sites BEGIN
+        {_for(_REMOVE_SITE, 'old')}
+        {_for(_ADD_SITE, 'new')}
+    END;
+'''
+
+
+# Position of a coordinate on the unit Web Mercator square
+def project(lat, lng):
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    x = (lng + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0.0), MAX_UNIT), min(max(y, 0.0), MAX_UNIT)
+
+
+# Refuse to install triggers this SQLite can't run, rather than failing on
+# the first insert
+def _check_sqlite(conn):
+    version = conn.execute('SELECT sqlite_version()').fetchone()[0]
+    try:
+        supported = tuple(int(part) for part in version.split('.')) >= MIN_SQLITE_VERSION
+        if supported:
+            conn.execute('SELECT ln(2), sin(radians(1)), pi()')
+    except sqlite3.OperationalError:
+        supported = False
+    if not supported:
+        raise RuntimeError(f"SQLite {version} can't maintain the map clusters: it needs "
+                           f"{'.'.join(map(str, MIN_SQLITE_VERSION))} or later with the built-in math functions")
+
+
+# Create and fill the pyramid if it is missing; the caller commits
+def ensure_clusters(conn):
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'site_clusters'").fetchone()
+    if not exists:
+        conn.execute(CLUSTER_SCHEMA)
+        rebuild(conn)
+
+
+# (Re)create the maintenance triggers; the caller commits
+def replace_triggers(conn):
+    _check_sqlite(conn)
+    for name in ('site_clusters_ai', 'site_clusters_ad', 'site_clusters_au'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    db.run_script(conn, TRIGGERS_SCHEMA)
+
+
+# Install the maintenance triggers and bring the pyramid up to date; the
+# caller commits
+def install_triggers(conn):
+    replace_triggers(conn)
+    rebuild(conn)
+
+
+# Recompute the whole pyramid from the sites table; the caller commits
+def rebuild(conn):
+    db.run_script(conn, SUPPORT_SCHEMA)
+    conn.execute('DELETE FROM site_cells')
+    conn.execute(f'''
+        INSERT INTO site_cells (site_id, cx, cy)
+        SELECT id, {_cell_x_sql('lng')}, {_cell_y_sql('lat')} FROM sites
+        WHERE lat IS NOT NULL AND lng IS NOT NULL
+    ''')
+    conn.execute('DELETE FROM site_clusters')
+    conn.execute(f'''
+        INSERT INTO site_clusters (zoom, cx, cy, count, sum_lat, sum_lng, site_id)
+        SELECT z.zoom, c.cx >> ({MAX_CLUSTER_ZOOM} - z.zoom) AS x, c.cy >> ({MAX_CLUSTER_ZOOM} - z.zoom) AS y,
+               COUNT(*), SUM(s.lat), SUM(s.lng), MAX(s.id)
+        FROM cluster_zooms z, site_cells c JOIN sites s ON s.id = c.site_id
+        GROUP BY z.zoom, x, y
+    ''')
+
+
+# Clusters inside map tile z/x/y. Single-site cells carry the popup fields.
+@metrics.timed('db', 'cluster_tile')
+def tile(conn, z, x, y):
+    rows = conn.execute('''
+        SELECT c.count, c.sum_lat / c.count AS lat, c.sum_lng / c.count AS lng,
+               s.id, s.title, substr(s.description, 1, 60) AS description, s.image, s.audio,
+               s.lat AS site_lat, s.lng AS site_lng
+        FROM site_clusters c JOIN sites s ON s.id = c.site_id
+        WHERE c.zoom = ? AND c.cx BETWEEN ? AND ? AND c.cy BETWEEN ? AND ?
+    ''', (z, x * CELLS_PER_TILE, (x + 1) * CELLS_PER_TILE - 1,
+          y * CELLS_PER_TILE, (y + 1) * CELLS_PER_TILE - 1)).fetchall()
+    features = []
+    for row in rows:
+        if row['count'] == 1:
+            features.append({'count': 1, 'id': row['id'], 'title': row['title'],
+                             'description': row['description'], 'image': row['image'],
+                             'audio': row['audio'], 'lat': row['site_lat'], 'lng': row['site_lng']})
+        else:
+            features.append({'count': row['count'], 'id': row['id'], 'image': row['image'],
+                             'lat': row['lat'], 'lng': row['lng']})
+    return features
+
+
+# Geographic bounds of tile z/x/y as (west, south, east, north)
+def tile_bounds(z, x, y):
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
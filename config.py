@@ -0,0 +1,35 @@
+import os
+
+# Configuration
+UPLOAD_FOLDER = 'Uploads'
+MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webm'}
+# Larger images are refused before any pixels are decoded
+MAX_IMAGE_PIXELS = 36_000_000
+
+# Flask side-app serving /sites and /Uploads to the map. The map fetches
+# API_URL from the visitor's browser, so when serving other machines set it
+# to an address they can reach.
+API_HOST = os.environ.get('STHALASPURTI_API_HOST', '0.0.0.0')
+API_PORT = int(os.environ.get('STHALASPURTI_API_PORT', 5001))
+API_URL = os.environ.get('STHALASPURTI_API_URL', f'http://localhost:{API_PORT}')
+
+# Resized copies of image uploads, generated in the background
+DERIVED_FOLDER = 'derived'
+DERIVATIVE_SIZES = (64, 200, 800)
+# Unreferenced uploads are only deleted once untouched for this long, so an
+# upload that is reusing the file has time to insert its site
+GC_GRACE_SECONDS = 3600
+# Longest side of the upload form's preview
+PREVIEW_SIZE = 480
+
+# A new upload is flagged as a likely duplicate of an existing site this
+# close by whose photo's perceptual hash differs in at most this many bits
+DUPLICATE_RADIUS_M = float(os.environ.get('STHALASPURTI_DUPLICATE_RADIUS_M', 100))
+DUPLICATE_MAX_DISTANCE = 10
+
+# Set when a reverse proxy serves Uploads/ itself via X-Sendfile
+USE_X_SENDFILE = os.environ.get('STHALASPURTI_X_SENDFILE', '') == '1'
+
+# Write a sampled stack profile of every Streamlit rerun into this folder
+PROFILE_DIR = os.environ.get('STHALASPURTI_PROFILE_DIR')
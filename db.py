@@ -0,0 +1,252 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+import metrics
+
+DB_PATH = 'heritage.db'
+BUSY_TIMEOUT = 5.0
+STATEMENT_CACHE = 256
+READER_POOL_SIZE = 8
+
+# Applied to every connection. WAL lets readers and the writer work at the
+# same time; with WAL, synchronous=NORMAL is still safe against corruption.
+PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Columns the Gallery cards actually render
+GALLERY_COLUMNS = 'id, title, description, category, image, audio, created_at'
+
+
+def connect(path=DB_PATH, check_same_thread=True):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread,
+                           cached_statements=STATEMENT_CACHE)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+# Run a multi-statement script inside the current transaction; executescript()
+# would commit first
+def run_script(conn, script):
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ''
+    if statement.strip():
+        conn.execute(statement)
+
+
+# Process-wide access to the database: a bounded pool of read connections
+# and a single writer that callers take turns on. Streamlit and werkzeug both
+# start a new thread per rerun or request, so readers are checked out per use
+# rather than kept per thread.
+class Database:
+    def __init__(self, path=DB_PATH, pool_size=READER_POOL_SIZE):
+        self.path = path
+        self._readers = queue.LifoQueue()
+        self._reader_slots = threading.Semaphore(pool_size)
+        self._write_lock = threading.Lock()
+        self._writer = connect(path, check_same_thread=False)
+        self._writer.execute('PRAGMA journal_mode = WAL')
+
+    # Check out a read-only connection for the duration of the block, opening
+    # one if the pool has none idle; blocks while pool_size are in use
+    @contextmanager
+    def reader(self):
+        with self._reader_slots:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = connect(self.path, check_same_thread=False)
+                conn.execute('PRAGMA query_only = 1')
+            try:
+                yield conn
+            finally:
+                # Don't hand the next caller an open read snapshot
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
+
+    # Goes up with every committed change to sites, from this process or any
+    # other (the importer, dedupe, migrations), so cached reads know when they
+    # are stale. The site_changes triggers keep the counter in the database.
+    @property
+    def version(self):
+        with self.reader() as conn:
+            return latest_change(conn)
+
+    # Serialised write transaction, committed on success and rolled back on error
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def get_database(path=DB_PATH):
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = Database(path)
+        return _database
+
+
+# Relative bm25 weights for title, description, category
+SEARCH_WEIGHTS = (10.0, 1.0, 5.0)
+
+
+# Insert one site; triggers fold it into the search index, the map clusters
+# and the other derived tables. Returns its id.
+@metrics.timed('db')
+def insert_site(conn, title, description, category, lat, lng, image, audio):
+    c = conn.execute('INSERT INTO sites (title, description, category, lat, lng, image, audio) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (title, description, category, lat, lng, image, audio))
+    return c.lastrowid
+
+
+# Count all sites without materialising any rows
+@metrics.timed('db')
+def count_sites(conn):
+    return conn.execute('SELECT COUNT(*) FROM sites').fetchone()[0]
+
+
+# Fetch one Gallery page, newest first.
+# `after` is the (created_at, id) of the last row on the previous page; when it
+# is known the page is read straight off idx_created_at (keyset pagination),
+# otherwise we fall back to OFFSET for direct jumps to an arbitrary page.
+@metrics.timed('db')
+def fetch_sites_page(conn, after=None, limit=6, offset=0):
+    if after is not None:
+        sql = (f'SELECT {GALLERY_COLUMNS} FROM sites WHERE (created_at, id) < (?, ?) '
+               'ORDER BY created_at DESC, id DESC LIMIT ?')
+        return conn.execute(sql, (*after, limit)).fetchall()
+    sql = f'SELECT {GALLERY_COLUMNS} FROM sites ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?'
+    return conn.execute(sql, (limit, offset)).fetchall()
+
+
+def page_cursor(rows):
+    if not rows:
+        return None
+    last = rows[-1]
+    return (last['created_at'], last['id'])
+
+
+# Every column a synced or exported copy of a site carries
+SYNC_COLUMNS = 'id, title, description, category, lat, lng, image, audio, created_at'
+CHANGES_SQL = '''
+    SELECT c.seq, c.deleted, c.site_id AS id, {columns}
+    FROM site_changes c LEFT JOIN sites s ON s.id = c.site_id
+    WHERE c.seq > ? ORDER BY c.seq
+'''.format(columns=', '.join(f's.{c.strip()}' for c in SYNC_COLUMNS.split(',')[1:]))
+
+
+# Sites added, edited or deleted after sync cursor `since`, oldest change
+# first. Deleted sites come back with deleted = 1 and their fields NULL. Read
+# off the seq index, so a sync costs what changed, not the table size.
+@metrics.timed('db')
+def fetch_changes(conn, since=0, limit=1000):
+    return conn.execute(CHANGES_SQL + ' LIMIT ?', (since, limit)).fetchall()
+
+
+# The same rows streamed from one statement, fetched batch_size at a time
+def iter_changes(conn, since=0, batch_size=1000):
+    cursor = conn.execute(CHANGES_SQL, (since,))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+# Cursor a client that has everything up to now should sync from
+def latest_change(conn):
+    return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM site_changes').fetchone()[0]
+
+
+# Turn free text from the search box into an FTS5 query: every word is
+# quoted so punctuation can't break the syntax, and the last one is a
+# prefix match so results appear while the user is still typing.
+def fts_query(text):
+    terms = [t.replace('"', '""') for t in text.split() if any(ch.isalnum() for ch in t)]
+    if not terms:
+        return None
+    return ' '.join(f'"{t}"' for t in terms) + '*'
+
+
+@metrics.timed('db')
+def count_search(conn, text):
+    query = fts_query(text)
+    if query is None:
+        return 0
+    return conn.execute('SELECT COUNT(*) FROM sites_fts WHERE sites_fts MATCH ?',
+                        (query,)).fetchone()[0]
+
+
+# Ranked search results with the matched words wrapped in ** for st.markdown
+@metrics.timed('db')
+def search_sites(conn, text, limit=6, offset=0):
+    query = fts_query(text)
+    if query is None:
+        return []
+    columns = ', '.join(f's.{c.strip()}' for c in GALLERY_COLUMNS.split(','))
+    sql = f'''
+        SELECT {columns},
+               highlight(sites_fts, 0, '**', '**') AS title_match,
+               snippet(sites_fts, 1, '**', '**', '…', 32) AS description_match
+        FROM sites_fts JOIN sites s ON s.id = sites_fts.rowid
+        WHERE sites_fts MATCH ?
+        ORDER BY bm25(sites_fts, ?, ?, ?)
+        LIMIT ? OFFSET ?
+    '''
+    return conn.execute(sql, (query, *SEARCH_WEIGHTS, limit, offset)).fetchall()
+
+
+# Columns the map popups and billboards use; descriptions are cut to what
+# the popup shows
+MAP_COLUMNS = 's.id, s.title, substr(s.description, 1, 60) AS description, s.image, s.audio, s.lat, s.lng'
+MAP_CELL_PX = 32
+
+
+# Sites inside a bounding box, read through the R*Tree. With a zoom level the
+# box is split into cells roughly MAP_CELL_PX screen pixels wide and only the
+# newest site in each cell is returned, so the payload follows the viewport
+# rather than how many sites it contains.
+@metrics.timed('db')
+def sites_in_bbox(conn, west, south, east, north, zoom=None, limit=500):
+    if west <= east:
+        lng_clause, lng_params = 'r.max_lng >= ? AND r.min_lng <= ?', [west, east]
+    else:
+        # Box crosses the antimeridian
+        lng_clause, lng_params = '(r.max_lng >= ? OR r.min_lng <= ?)', [west, east]
+    sql = f'''
+        SELECT {MAP_COLUMNS}{{extra}}
+        FROM sites_rtree r JOIN sites s ON s.id = r.id
+        WHERE r.max_lat >= ? AND r.min_lat <= ? AND {lng_clause}
+        {{group}}
+        ORDER BY s.id DESC LIMIT ?
+    '''
+    params = [south, north, *lng_params]
+    if zoom is None:
+        sql = sql.format(extra='', group='')
+    else:
+        cell = 360.0 / (256 * 2 ** zoom) * MAP_CELL_PX
+        sql = sql.format(extra=', MAX(s.id) AS newest',
+                         group='GROUP BY CAST(s.lat / ? AS INTEGER), CAST(s.lng / ? AS INTEGER)')
+        params.extend([cell, cell])
+    return conn.execute(sql, [*params, limit]).fetchall()
@@ -0,0 +1,189 @@
+import argparse
+import math
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import db
+import media
+import metrics
+import migrations
+from config import UPLOAD_FOLDER, DUPLICATE_RADIUS_M, DUPLICATE_MAX_DISTANCE
+
+# Near-duplicate sites: two sites are likely the same place when they are
+# within DUPLICATE_RADIUS_M of each other and their photos' perceptual hashes
+# (media.perceptual_hash, stored in image_hashes) differ in at most
+# DUPLICATE_MAX_DISTANCE bits.
+#   python dedupe.py --radius 100 --max-distance 10
+# hashes any images that don't have one yet, then lists duplicate clusters.
+EARTH_RADIUS_M = 6371000
+METRES_PER_DEGREE = 111320
+HASH_MASK = (1 << 64) - 1
+HASH_BATCH = 500
+
+
+def hamming(a, b):
+    return bin((a ^ b) & HASH_MASK).count('1')
+
+
+def distance_m(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def _lng_span(lat, radius_m):
+    return radius_m / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+
+
+def store_hash(conn, path, phash):
+    conn.execute('INSERT OR IGNORE INTO image_hashes (path, phash) VALUES (?, ?)', (path, phash))
+
+
+# Existing sites that look like the same place as a new photo at lat/lng,
+# closest hash first. The R*Tree narrows the search to the radius, so this
+# costs the same at 100 or 100k sites.
+@metrics.timed('db')
+def find_duplicates(conn, lat, lng, phash, radius_m=DUPLICATE_RADIUS_M,
+                    max_distance=DUPLICATE_MAX_DISTANCE, limit=5):
+    dlat, dlng = radius_m / METRES_PER_DEGREE, _lng_span(lat, radius_m)
+    rows = conn.execute('''
+        SELECT s.id, s.title, s.image, s.lat, s.lng, h.phash
+        FROM sites_rtree r JOIN sites s ON s.id = r.id JOIN image_hashes h ON h.path = s.image
+        WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lng >= ? AND r.min_lng <= ?
+    ''', (lat - dlat, lat + dlat, lng - dlng, lng + dlng)).fetchall()
+    matches = []
+    for row in rows:
+        bits = hamming(phash, row['phash'])
+        if bits > max_distance:
+            continue
+        metres = distance_m(lat, lng, row['lat'], row['lng'])
+        if metres <= radius_m:
+            matches.append(dict(row, hash_distance=bits, distance_m=round(metres)))
+    matches.sort(key=lambda m: (m['hash_distance'], m['distance_m']))
+    return matches[:limit]
+
+
+# Burkhard-Keller tree over hashes under Hamming distance: a search only
+# descends into children whose edge distance is within max_distance of the
+# query's distance to the node, by the triangle inequality.
+class BKTree:
+    def __init__(self):
+        self.root = None
+
+    def add(self, phash, item):
+        if self.root is None:
+            self.root = (phash, [item], {})
+            return
+        node = self.root
+        while True:
+            d = hamming(phash, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = (phash, [item], {})
+                return
+            node = child
+
+    def search(self, phash, max_distance):
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(phash, node[0])
+            if d <= max_distance:
+                found.extend((d, item) for item in node[1])
+            stack.extend(child for edge, child in node[2].items()
+                         if d - max_distance <= edge <= d + max_distance)
+        return found
+
+
+# Group the whole collection into clusters of likely duplicates. Sites are
+# bucketed into grid cells one radius high with a BK-tree per cell, so each
+# site is only compared with the similar hashes in its neighbourhood.
+def duplicate_clusters(conn, radius_m=DUPLICATE_RADIUS_M, max_distance=DUPLICATE_MAX_DISTANCE):
+    cell = radius_m / METRES_PER_DEGREE
+    trees = defaultdict(BKTree)
+    sites = conn.execute('''
+        SELECT s.id, s.lat, s.lng, h.phash FROM sites s JOIN image_hashes h ON h.path = s.image
+        WHERE s.lat IS NOT NULL AND s.lng IS NOT NULL
+    ''').fetchall()
+    for site_id, lat, lng, phash in sites:
+        trees[(int(lat // cell), int(lng // cell))].add(phash, (site_id, lat, lng))
+
+    parent = {}
+
+    def find(x):
+        while parent.get(x, x) != x:
+            parent[x] = parent.get(parent[x], parent[x])
+            x = parent[x]
+        return x
+
+    for site_id, lat, lng, phash in sites:
+        row, col = int(lat // cell), int(lng // cell)
+        span = math.ceil(_lng_span(lat, radius_m) / cell)
+        for r in range(row - 1, row + 2):
+            for c in range(col - span, col + span + 1):
+                tree = trees.get((r, c))
+                if tree is None:
+                    continue
+                for _, (other, other_lat, other_lng) in tree.search(phash, max_distance):
+                    if other > site_id and distance_m(lat, lng, other_lat, other_lng) <= radius_m:
+                        a, b = find(site_id), find(other)
+                        parent[a] = a
+                        parent[b] = a
+
+    groups = defaultdict(list)
+    for site_id in parent:
+        groups[find(site_id)].append(site_id)
+    return sorted((sorted(ids) for ids in groups.values()), key=lambda ids: (-len(ids), ids[0]))
+
+
+def _hash_file(path, upload_folder):
+    return media.perceptual_hash(os.path.join(upload_folder, path), path.rsplit('.', 1)[1].lower())
+
+
+# Hash site images that don't have one yet, e.g. from before hashing or from
+# the bulk importer
+def backfill(conn, upload_folder=UPLOAD_FOLDER, workers=None):
+    pending = [path for (path,) in conn.execute('''
+        SELECT DISTINCT s.image FROM sites s LEFT JOIN image_hashes h ON h.path = s.image
+        WHERE s.image IS NOT NULL AND h.path IS NULL
+    ''') if media.is_image(path)]
+    print(f"{len(pending)} images need hashes")
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(pending), HASH_BATCH):
+            batch = pending[start:start + HASH_BATCH]
+            futures = [(path, pool.submit(_hash_file, path, upload_folder)) for path in batch]
+            with conn:
+                for path, future in futures:
+                    try:
+                        store_hash(conn, path, future.result())
+                    except Exception as e:
+                        failed += 1
+                        print(f"  skipped {path}: {e}")
+    return len(pending) - failed, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find near-duplicate heritage sites")
+    parser.add_argument('--radius', type=float, default=DUPLICATE_RADIUS_M, help="metres")
+    parser.add_argument('--max-distance', type=int, default=DUPLICATE_MAX_DISTANCE,
+                        help="differing hash bits, out of 64")
+    parser.add_argument('--uploads', default=UPLOAD_FOLDER)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrations.migrate(conn)
+    backfill(conn, args.uploads, args.workers)
+    titles = dict(conn.execute('SELECT id, title FROM sites'))
+    found = duplicate_clusters(conn, args.radius, args.max_distance)
+    for ids in found:
+        print(f"{len(ids)} sites: " + '; '.join(f"#{i} {titles[i]}" for i in ids))
+    print(f"{len(found)} clusters, {sum(len(ids) for ids in found)} sites")
+    conn.close()
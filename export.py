@@ -0,0 +1,112 @@
+import argparse
+import json
+import sys
+import db
+import migrations
+
+# Stream the collection out for offline kiosks and analytics jobs.
+#   python export.py --format geojson --output sites.geojson
+# Rows are written as they are read from a single cursor, so memory use does
+# not grow with the collection. The sync cursor printed at the end is where a
+# client holding this export continues with /sites/changes?since=.
+BATCH_SIZE = 1000
+PARQUET_ROW_GROUP = 10000
+SYNC_FIELDS = db.SYNC_COLUMNS.split(', ')
+
+
+def _site(row):
+    return {key: row[key] for key in SYNC_FIELDS}
+
+
+def _feature(row):
+    properties = {key: row[key] for key in SYNC_FIELDS if key not in ('lat', 'lng')}
+    geometry = None
+    if row['lat'] is not None and row['lng'] is not None:
+        geometry = {"type": "Point", "coordinates": [row['lng'], row['lat']]}
+    return {"type": "Feature", "id": row['id'], "geometry": geometry, "properties": properties}
+
+
+def write_ndjson(rows, out):
+    for row in rows:
+        out.write(json.dumps(_site(row), ensure_ascii=False) + '\n')
+
+
+def write_geojson(rows, out):
+    out.write('{"type": "FeatureCollection", "features": [\n')
+    for i, row in enumerate(rows):
+        out.write((',\n' if i else '') + json.dumps(_feature(row), ensure_ascii=False))
+    out.write('\n]}\n')
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(_site(row))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# One row group per PARQUET_ROW_GROUP sites; pyarrow is only needed here
+def write_parquet(rows, out):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet export needs pyarrow: pip install pyarrow")
+    schema = pa.schema([
+        ('id', pa.int64()), ('title', pa.string()), ('description', pa.string()),
+        ('category', pa.string()), ('lat', pa.float64()), ('lng', pa.float64()),
+        ('image', pa.string()), ('audio', pa.string()), ('created_at', pa.string()),
+    ])
+    with pq.ParquetWriter(out, schema) as writer:
+        for batch in _batches(rows, PARQUET_ROW_GROUP):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+
+WRITERS = {'geojson': write_geojson, 'ndjson': write_ndjson, 'parquet': write_parquet}
+
+
+# Write every site changed after `since` (all of them for 0) and return the
+# number written and the sync cursor the export is current to
+def export(conn, fmt, out, since=0):
+    count = 0
+
+    def sites():
+        nonlocal count
+        for row in db.iter_changes(conn, since, BATCH_SIZE):
+            if not row['deleted']:
+                count += 1
+                yield row
+
+    # One read transaction, so the cursor matches exactly the rows written
+    with conn:
+        conn.execute('BEGIN')
+        cursor = db.latest_change(conn)
+        WRITERS[fmt](sites(), out)
+    return count, cursor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export heritage sites")
+    parser.add_argument('--format', choices=sorted(WRITERS), default='ndjson')
+    parser.add_argument('--output', help="file to write (default: stdout, except for parquet)")
+    parser.add_argument('--since', type=int, default=0, help="only sites changed after this sync cursor")
+    parser.add_argument('--database', default=db.DB_PATH)
+    args = parser.parse_args()
+    if args.format == 'parquet' and not args.output:
+        parser.error("--output is required for parquet")
+
+    conn = db.connect(args.database)
+    migrations.migrate(conn)
+    if args.format == 'parquet':
+        count, cursor = export(conn, args.format, args.output, args.since)
+    elif args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            count, cursor = export(conn, args.format, f, args.since)
+    else:
+        count, cursor = export(conn, args.format, sys.stdout, args.since)
+    conn.close()
+    print(f"{count} sites exported, sync cursor {cursor}", file=sys.stderr)
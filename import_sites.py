@@ -0,0 +1,199 @@
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import ExifTags, Image
+import db
+import media
+import migrations
+import storage
+from config import MAX_FILE_SIZE
+
+# Bulk import of field surveys, either a folder of geotagged photos or a
+# CSV/JSONL manifest with title, description, category, lat, lng, image,
+# audio and optional created_at columns (media paths relative to the
+# manifest). Every imported source is recorded in the same transaction as its
+# site row, so an interrupted run picks up where it stopped.
+BATCH_SIZE = 500
+INSERT_SITE = '''
+    INSERT INTO sites (title, description, category, lat, lng, image, audio, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+'''
+
+
+def _degrees(value, ref):
+    degrees, minutes, seconds = (float(v) for v in value)
+    result = degrees + minutes / 60 + seconds / 3600
+    return -result if ref in ('S', 'W') else result
+
+
+# Location, capture time and caption from a photo's EXIF block
+def read_exif(path):
+    with Image.open(path) as img:
+        exif = img.getexif()
+    gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+    lat = lng = None
+    if ExifTags.GPS.GPSLatitude in gps and ExifTags.GPS.GPSLongitude in gps:
+        lat = _degrees(gps[ExifTags.GPS.GPSLatitude], gps.get(ExifTags.GPS.GPSLatitudeRef))
+        lng = _degrees(gps[ExifTags.GPS.GPSLongitude], gps.get(ExifTags.GPS.GPSLongitudeRef))
+    taken = exif.get_ifd(ExifTags.IFD.Exif).get(ExifTags.Base.DateTimeOriginal)
+    created_at = taken.replace(':', '-', 2) if taken else None
+    caption = exif.get(ExifTags.Base.ImageDescription)
+    return lat, lng, created_at, caption
+
+
+def scan_directory(folder, category):
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if media.is_image(name):
+                path = os.path.abspath(os.path.join(root, name))
+                yield {'source': path, 'image': path, 'category': category,
+                       'title': os.path.splitext(name)[0].replace('_', ' ')}
+
+
+# Empty CSV cells and JSON nulls are missing values; 0 is a real coordinate
+def _value(record, key):
+    value = record.get(key)
+    return None if value is None or value == '' else value
+
+
+def read_manifest(path):
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.csv'):
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for line_no, record in enumerate(records, 1):
+            item = {key: _value(record, key) for key in
+                    ('title', 'description', 'category', 'lat', 'lng', 'image', 'audio', 'created_at')}
+            for key in ('image', 'audio'):
+                if item[key]:
+                    item[key] = os.path.join(base, item[key])
+            item['source'] = f"{os.path.abspath(path)}:{line_no}"
+            yield item
+
+
+# Same rules as the upload form
+def _validate(path):
+    if not storage.allowed_file(path):
+        raise ValueError(f"Invalid file type: {os.path.basename(path)}")
+    if os.path.getsize(path) > MAX_FILE_SIZE:
+        raise ValueError(f"File size exceeds 5MB limit: {os.path.basename(path)}")
+    ext = path.rsplit('.', 1)[1].lower()
+    with open(path, 'rb') as f:
+        if not storage.matches_signature(f.read(16), ext):
+            raise ValueError(f"Not a valid {ext.upper()} file: {os.path.basename(path)}")
+    if media.is_image(path):
+        media.open_checked(path, ext).close()
+
+
+# Copy an already validated file into the store
+def _store(path):
+    ext = path.rsplit('.', 1)[1].lower()
+    with open(path, 'rb') as f:
+        stored, _ = storage.store_file(f, ext, max_size=MAX_FILE_SIZE)
+    return stored
+
+
+# Validate one item and copy its media into the store; runs on a worker thread
+def prepare(item):
+    if not item.get('image'):
+        raise ValueError("No image")
+    _validate(item['image'])
+    lat, lng = item.get('lat'), item.get('lng')
+    created_at, description = item.get('created_at'), item.get('description')
+    if lat is None or lng is None:
+        lat, lng, taken, caption = read_exif(item['image'])
+        created_at = created_at or taken
+        description = description or caption
+        if lat is None or lng is None:
+            raise ValueError("No GPS location")
+    lat, lng = float(lat), float(lng)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Location out of range")
+    title = (item.get('title') or '').strip()[:100]
+    description = (description or title).strip()[:1000]
+    if not title:
+        raise ValueError("Title must be between 1 and 100 characters")
+    category = (item.get('category') or 'other').split(' / ')[0].lower()
+    if item.get('audio'):
+        _validate(item['audio'])
+    image = _store(item['image'])
+    audio = _store(item['audio']) if item.get('audio') else None
+    return (title, description, category, lat, lng, image, audio, created_at)
+
+
+# Insert one batch in a single transaction. Sites get consecutive ids because
+# the batch holds the write lock, so the resume log can be filled in without
+# a round trip per row.
+def _insert_batch(conn, sources, rows):
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(INSERT_SITE, rows)
+        last_id = conn.execute('SELECT MAX(id) FROM sites').fetchone()[0]
+        ids = range(last_id - len(rows) + 1, last_id + 1)
+        conn.executemany('INSERT INTO imports (source, site_id) VALUES (?, ?)', zip(sources, ids))
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_items(conn, items, workers=8, batch_size=BATCH_SIZE):
+    done = {source for (source,) in conn.execute('SELECT source FROM imports')}
+    pending = [item for item in items if item['source'] not in done]
+    print(f"{len(pending)} to import, {len(done)} already imported")
+    imported = failed = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in _batches(pending, batch_size):
+            futures = [(item['source'], pool.submit(prepare, item)) for item in batch]
+            sources, rows = [], []
+            for source, future in futures:
+                try:
+                    rows.append(future.result())
+                    sources.append(source)
+                except Exception as e:
+                    failed += 1
+                    print(f"  skipped {source}: {e}")
+            if rows:
+                _insert_batch(conn, sources, rows)
+                imported += len(rows)
+            elapsed = time.monotonic() - start
+            print(f"{imported + failed}/{len(pending)} processed, {imported} imported, "
+                  f"{failed} skipped, {imported / elapsed if elapsed else 0:.0f} sites/s")
+    return imported, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk import heritage sites")
+    parser.add_argument('source', help="folder of geotagged photos, or a .csv/.jsonl manifest")
+    parser.add_argument('--category', default='other', help="category for photo folders")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--skip-derivatives', action='store_true',
+                        help="don't generate thumbnails afterwards")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrations.migrate(conn)
+    if os.path.isdir(args.source):
+        items = scan_directory(args.source, args.category)
+    else:
+        items = read_manifest(args.source)
+    import_items(conn, items, args.workers, args.batch_size)
+    conn.close()
+    if not args.skip_derivatives:
+        media.backfill()
@@ -0,0 +1,216 @@
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps, features
+import metrics
+from config import UPLOAD_FOLDER, DERIVED_FOLDER, DERIVATIVE_SIZES, MAX_IMAGE_PIXELS, PREVIEW_SIZE
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+HASH_SIZE = 8
+# The only decoder Pillow may use for each extension
+PIL_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG', 'gif': 'GIF'}
+# 64px is the Cesium billboard, drawn as a fixed square
+SQUARE_SIZES = {64}
+DERIVATIVE_FORMAT, DERIVATIVE_EXT = ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def derivative_name(filename, size):
+    stem = filename.rsplit('.', 1)[0]
+    return f"{stem}_{size}.{DERIVATIVE_EXT}"
+
+
+# Path of the size-specific copy of an upload, or of the original while the
+# derivative has not been generated yet
+def image_path(filename, size, upload_folder=UPLOAD_FOLDER):
+    derived = os.path.join(upload_folder, DERIVED_FOLDER, derivative_name(filename, size))
+    if os.path.exists(derived):
+        return derived
+    return os.path.join(upload_folder, filename)
+
+
+def is_image(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+# Open an image for decoding. Only the header has been read when this
+# returns, and it has already been checked: the file must be the format its
+# extension claims and at most MAX_IMAGE_PIXELS, so a small file that
+# inflates to a huge bitmap is refused before it costs any memory.
+def open_checked(fp, ext):
+    try:
+        img = Image.open(fp, formats=[PIL_FORMATS[ext]])
+    except (KeyError, Image.UnidentifiedImageError, Image.DecompressionBombError):
+        raise ValueError(f"File is not a valid {ext.upper()} image")
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        img.close()
+        raise ValueError(f"Image is too large ({img.width}x{img.height}); "
+                         f"the limit is {MAX_IMAGE_PIXELS // 1_000_000} megapixels")
+    return img
+
+
+def _output_mode(img):
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    return 'RGBA' if has_alpha and DERIVATIVE_FORMAT == 'WEBP' else 'RGB'
+
+
+# Decode an upload at preview scale, upright. Large JPEGs are decoded
+# straight at a reduced scale, so this stays cheap whatever the camera.
+def _decode_preview(fp, ext, size):
+    with open_checked(fp, ext) as img:
+        img.draft('RGB', (size, size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size))
+        return img
+
+
+# Small encoded preview of an upload for the form, and its perceptual hash
+# from the same decode
+@metrics.timed('image')
+def make_preview(fp, ext, size=PREVIEW_SIZE):
+    img = _decode_preview(fp, ext, size)
+    phash = _dhash(img)
+    out = io.BytesIO()
+    img.convert(_output_mode(img)).save(out, DERIVATIVE_FORMAT, quality=80)
+    return out.getvalue(), phash
+
+
+# Decode an upload once and write every derivative size. EXIF orientation is
+# applied to the pixels and no metadata is carried over to the copies.
+@metrics.timed('image')
+def make_derivatives(filename, upload_folder=UPLOAD_FOLDER):
+    target = os.path.join(upload_folder, DERIVED_FOLDER)
+    largest = max(DERIVATIVE_SIZES)
+    ext = filename.rsplit('.', 1)[1].lower()
+    with open_checked(os.path.join(upload_folder, filename), ext) as img:
+        # JPEGs are decoded straight at a reduced scale when they are large
+        img.draft('RGB', (largest, largest))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert(_output_mode(img))
+
+    written = []
+    for size in sorted(DERIVATIVE_SIZES, reverse=True):
+        if size in SQUARE_SIZES:
+            out = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        else:
+            out = img.copy()
+            out.thumbnail((size, size), Image.LANCZOS)
+        name = derivative_name(filename, size)
+        path = os.path.join(target, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        out.save(path + '.tmp', DERIVATIVE_FORMAT, quality=80)
+        os.replace(path + '.tmp', path)
+        written.append(name)
+    return written
+
+
+# 64-bit difference hash: one bit per neighbouring pixel pair of a 9x8
+# greyscale thumbnail, set where brightness falls to the right. Survives
+# re-encoding, resizing and small crops; compare two with dedupe.hamming().
+# Signed so it fits an SQLite INTEGER.
+def _dhash(img):
+    pixels = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            i = row * (HASH_SIZE + 1) + col
+            value = value << 1 | (pixels[i] > pixels[i + 1])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+# Hash of a stored file, from the same preview-scale decode as the upload
+# form, so both give the same value for the same image
+@metrics.timed('image')
+def perceptual_hash(fp, ext):
+    return _dhash(_decode_preview(fp, ext, PREVIEW_SIZE))
+
+
+def has_derivatives(filename, upload_folder=UPLOAD_FOLDER):
+    target = os.path.join(upload_folder, DERIVED_FOLDER)
+    return all(os.path.exists(os.path.join(target, derivative_name(filename, size)))
+               for size in DERIVATIVE_SIZES)
+
+
+# One worker pool per process. Spawned rather than forked because the
+# Streamlit and Flask servers are multi-threaded.
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=min(2, os.cpu_count() or 1),
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _log_failure(future):
+    if future.exception():
+        logger.error("Generating derivatives failed: %s", future.exception())
+
+
+# Derivatives are made in the worker processes, whose metrics never reach
+# /metrics, so time each job here from submission to completion instead
+def _observe_job(start):
+    def done(future):
+        metrics.record_span('image', 'derivatives_job', time.perf_counter() - start)
+    return done
+
+
+# Queue derivative generation without blocking the caller. Re-uploads of
+# stored content already have theirs.
+def submit_derivatives(filename, upload_folder=UPLOAD_FOLDER):
+    if not filename or not is_image(filename) or has_derivatives(filename, upload_folder):
+        return None
+    start = time.perf_counter()
+    future = _get_pool().submit(make_derivatives, filename, upload_folder)
+    future.add_done_callback(_log_failure)
+    future.add_done_callback(_observe_job(start))
+    return future
+
+
+# Uploads relative to the upload folder, both legacy flat names and
+# content-addressed ab/cd/ paths, skipping derivatives and partial writes
+def _stored_files(upload_folder):
+    for root, dirs, files in os.walk(upload_folder):
+        dirs[:] = sorted(d for d in dirs if d != DERIVED_FOLDER and not d.startswith('.'))
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), upload_folder).replace(os.sep, '/')
+
+
+# Generate derivatives for uploads that don't have them yet
+def backfill(upload_folder=UPLOAD_FOLDER, workers=None):
+    pending = [name for name in _stored_files(upload_folder)
+               if is_image(name) and not has_derivatives(name, upload_folder)]
+    print(f"{len(pending)} uploads need derivatives")
+    done = failed = 0
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(make_derivatives, name, upload_folder) for name in pending}
+        for name, future in futures.items():
+            try:
+                future.result()
+                done += 1
+            except Exception as e:
+                failed += 1
+                print(f"  {name}: {e}")
+    print(f"Generated {done}, failed {failed} in {time.monotonic() - start:.1f}s")
+    return done, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sthalaspurti media tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = commands.add_parser('backfill', help="generate missing image derivatives")
+    backfill_parser.add_argument('--uploads', default=UPLOAD_FOLDER)
+    backfill_parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    if args.command == 'backfill':
+        backfill(args.uploads, args.workers)
@@ -0,0 +1,205 @@
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from config import PROFILE_DIR
+
+# In-process metrics rendered in the Prometheus text format by /metrics.
+# Hot paths are wrapped in spans, each recorded in a latency histogram
+# labelled by kind (db, file, image, render, http) and name.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_INTERVAL = 0.005
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_help = {}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(metric, help_text, amount=1, **labels):
+    with _lock:
+        _help.setdefault(metric, ('counter', help_text))
+        series = _counters.setdefault(metric, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + amount
+
+
+def observe(metric, help_text, value, **labels):
+    with _lock:
+        _help.setdefault(metric, ('histogram', help_text))
+        series = _histograms.setdefault(metric, {})
+        key = _label_key(labels)
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [[0] * len(BUCKETS), 0, 0.0]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += 1
+        state[2] += value
+
+
+def record_span(kind, name, seconds):
+    observe('sthalaspurti_span_seconds', "Time spent in instrumented code", seconds,
+            kind=kind, name=name)
+
+
+# Report a value read at scrape time, e.g. cache hit counts
+def register_gauge(metric, help_text, read):
+    with _lock:
+        _help[metric] = ('gauge', help_text)
+        _gauges[metric] = read
+
+
+class span:
+    # Time a block: `with span('db', 'fetch_sites_page'): ...`
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_span(self.kind, self.name, time.perf_counter() - self.start)
+        # Streamlit's st.stop() and reruns unwind through here; they are not failures
+        if exc_type is not None and issubclass(exc_type, Exception) \
+                and exc_type.__module__.split('.')[0] != 'streamlit':
+            inc('sthalaspurti_span_errors_total', "Instrumented blocks that raised",
+                kind=self.kind, name=self.name)
+        return False
+
+
+def timed(kind, name=None):
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in pairs)
+    return '{' + body + '}'
+
+
+def render():
+    lines = []
+    with _lock:
+        for name, series in sorted(_counters.items()):
+            lines += [f"# HELP {name} {_help[name][1]}", f"# TYPE {name} counter"]
+            lines += [f"{name}{_format_labels(key)} {value}" for key, value in sorted(series.items())]
+        for name, series in sorted(_histograms.items()):
+            lines += [f"# HELP {name} {_help[name][1]}", f"# TYPE {name} histogram"]
+            for key, (buckets, count, total) in sorted(series.items()):
+                for bound, hits in zip(BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {hits}")
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        gauges = sorted(_gauges.items())
+    for name, read in gauges:
+        lines += [f"# HELP {name} {_help[name][1]}", f"# TYPE {name} gauge", f"{name} {read()}"]
+    return '\n'.join(lines) + '\n'
+
+
+# Samples one thread's stack every PROFILE_INTERVAL seconds from a background
+# thread and writes the counts in collapsed-stack format, which flamegraph.pl
+# and speedscope read directly. Cheap enough to leave on while reproducing a
+# slow page.
+class SamplingProfiler:
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self.started = time.time()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self, path=None):
+        self._stopped.set()
+        self._thread.join()
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        return self.samples
+
+
+# Per-rerun profiling for the Streamlit script, on when PROFILE_DIR is set.
+# `state` is the session state, which also picks up a profile left running
+# when a rerun ended early via st.stop().
+def start_rerun_profile(state, name='rerun'):
+    if not PROFILE_DIR:
+        return None
+    finish_rerun_profile(state)
+    profiler = SamplingProfiler().start()
+    state['_profiler'] = (profiler, name)
+    return profiler
+
+
+def finish_rerun_profile(state):
+    entry = state.pop('_profiler', None) if PROFILE_DIR else None
+    if entry is None:
+        return None
+    profiler, name = entry
+    return _write_profile(profiler, name)
+
+
+def _write_profile(profiler, name):
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(profiler.started))
+    path = os.path.join(PROFILE_DIR, f"{name}-{stamp}-{int(profiler.started * 1000) % 1000:03d}.folded")
+    profiler.stop(path)
+    return path
+
+
+# Profile each call into its own file, for st.fragment functions: a fragment
+# rerun runs only the fragment, not the script around the rerun profile
+def profiled(name=None):
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILE_DIR:
+                return func(*args, **kwargs)
+            profiler = SamplingProfiler().start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _write_profile(profiler, label)
+        return wrapper
+    return decorate
@@ -0,0 +1,229 @@
+import argparse
+import clusters
+import db
+
+# Versioned schema migrations. Each step runs in its own transaction together
+# with the PRAGMA user_version bump that records it, so a database is always
+# at a well-defined version and startup costs one PRAGMA read once it is
+# current. Steps are written to also upgrade databases created before
+# versioning, which may already have some of these objects.
+
+SITES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sites
+        (id INTEGER PRIMARY KEY, title TEXT, description TEXT,
+         category TEXT, lat REAL, lng REAL, image TEXT, audio TEXT,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+'''
+
+# Full-text index over the story fields. The default unicode61 tokenizer
+# splits Telugu words at every vowel sign, so combining marks (M*) are
+# counted as token characters too.
+SEARCH_SCHEMA = '''
+    CREATE VIRTUAL TABLE sites_fts USING fts5(
+        title, description, category,
+        content='sites', content_rowid='id',
+        tokenize="unicode61 categories 'L* N* Co M*'",
+        prefix='2 3'
+    );
+    CREATE TRIGGER sites_fts_ai AFTER INSERT ON sites BEGIN
+        INSERT INTO sites_fts(rowid, title, description, category)
+        VALUES (new.id, new.title, new.description, new.category);
+    END;
+    CREATE TRIGGER sites_fts_ad AFTER DELETE ON sites BEGIN
+        INSERT INTO sites_fts(sites_fts, rowid, title, description, category)
+        VALUES ('delete', old.id, old.title, old.description, old.category);
+    END;
+    CREATE TRIGGER sites_fts_au AFTER UPDATE OF title, description, category ON sites BEGIN
+        INSERT INTO sites_fts(sites_fts, rowid, title, description, category)
+        VALUES ('delete', old.id, old.title, old.description, old.category);
+        INSERT INTO sites_fts(rowid, title, description, category)
+        VALUES (new.id, new.title, new.description, new.category);
+    END;
+    INSERT INTO sites_fts(sites_fts) VALUES ('rebuild');
+'''
+
+# R*Tree over site coordinates so map viewports are answered from the index
+# instead of scanning every row. Sites without a location are left out.
+SPATIAL_SCHEMA = '''
+    CREATE VIRTUAL TABLE sites_rtree USING rtree(id, min_lat, max_lat, min_lng, max_lng);
+    CREATE TRIGGER sites_rtree_ai AFTER INSERT ON sites
+    WHEN new.lat IS NOT NULL AND new.lng IS NOT NULL BEGIN
+        INSERT INTO sites_rtree VALUES (new.id, new.lat, new.lat, new.lng, new.lng);
+    END;
+    CREATE TRIGGER sites_rtree_ad AFTER DELETE ON sites BEGIN
+        DELETE FROM sites_rtree WHERE id = old.id;
+    END;
+    CREATE TRIGGER sites_rtree_au AFTER UPDATE OF lat, lng ON sites BEGIN
+        DELETE FROM sites_rtree WHERE id = old.id;
+        INSERT INTO sites_rtree SELECT new.id, new.lat, new.lat, new.lng, new.lng
+        WHERE new.lat IS NOT NULL AND new.lng IS NOT NULL;
+    END;
+    INSERT INTO sites_rtree
+        SELECT id, lat, lat, lng, lng FROM sites WHERE lat IS NOT NULL AND lng IS NOT NULL;
+'''
+
+# Reference counts for stored upload files, kept by triggers so every way of
+# adding or removing a site keeps them right. Files whose count drops to zero
+# are removed by storage.collect_garbage().
+MEDIA_SCHEMA = '''
+    CREATE TABLE media (path TEXT PRIMARY KEY, refs INTEGER NOT NULL) WITHOUT ROWID;
+    CREATE TRIGGER media_ai AFTER INSERT ON sites BEGIN
+        INSERT INTO media (path, refs)
+        SELECT path, 1 FROM (SELECT new.image AS path UNION ALL SELECT new.audio) WHERE path IS NOT NULL
+        ON CONFLICT (path) DO UPDATE SET refs = refs + 1;
+    END;
+    CREATE TRIGGER media_ad AFTER DELETE ON sites BEGIN
+        UPDATE media SET refs = refs - 1 WHERE path = old.image;
+        UPDATE media SET refs = refs - 1 WHERE path = old.audio;
+    END;
+    CREATE TRIGGER media_au AFTER UPDATE OF image, audio ON sites BEGIN
+        UPDATE media SET refs = refs - 1 WHERE path = old.image;
+        UPDATE media SET refs = refs - 1 WHERE path = old.audio;
+        INSERT INTO media (path, refs)
+        SELECT path, 1 FROM (SELECT new.image AS path UNION ALL SELECT new.audio) WHERE path IS NOT NULL
+        ON CONFLICT (path) DO UPDATE SET refs = refs + 1;
+    END;
+    INSERT INTO media (path, refs)
+        SELECT path, COUNT(*) FROM (SELECT image AS path FROM sites UNION ALL SELECT audio FROM sites)
+        WHERE path IS NOT NULL GROUP BY path;
+'''
+
+LEGACY_MERGE = '''
+    INSERT INTO sites (title, description, category, lat, lng, image, audio, created_at)
+    SELECT title, description, category, latitude, longitude, image_path, audio_path,
+           COALESCE(timestamp, CURRENT_TIMESTAMP)
+    FROM heritage_sites ORDER BY id;
+    DROP TABLE heritage_sites;
+'''
+
+IMPORTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS imports (source TEXT PRIMARY KEY, site_id INTEGER)
+'''
+
+# Indexes for the queries the app actually runs. idx_sites_gallery covers
+# every Gallery card column in created_at order, so a page is read from the
+# index alone and it replaces idx_created_at. Map lookups go through the
+# sites_rtree spatial index.
+ACCESS_PATH_INDEXES = '''
+    CREATE INDEX IF NOT EXISTS idx_sites_category_created ON sites (category, created_at);
+    CREATE INDEX IF NOT EXISTS idx_sites_gallery
+        ON sites (created_at, id, title, description, category, image, audio);
+    DROP INDEX IF EXISTS idx_created_at;
+'''
+
+# Change log for incremental sync: one row per site holding the sequence
+# number of its latest insert, update or delete. Deleted sites stay as
+# tombstones so clients learn to drop them. Commits are serialised, so a
+# reader never sees a later sequence number before an earlier one.
+CHANGES_SCHEMA = '''
+    CREATE TABLE site_changes
+        (site_id INTEGER PRIMARY KEY, seq INTEGER NOT NULL, deleted INTEGER NOT NULL DEFAULT 0);
+    CREATE UNIQUE INDEX idx_site_changes_seq ON site_changes (seq);
+    CREATE TRIGGER site_changes_ai AFTER INSERT ON sites BEGIN
+        INSERT OR REPLACE INTO site_changes (site_id, seq, deleted)
+        VALUES (new.id, (SELECT COALESCE(MAX(seq), 0) + 1 FROM site_changes), 0);
+    END;
+    CREATE TRIGGER site_changes_au AFTER UPDATE ON sites BEGIN
+        INSERT OR REPLACE INTO site_changes (site_id, seq, deleted)
+        VALUES (new.id, (SELECT COALESCE(MAX(seq), 0) + 1 FROM site_changes), 0);
+    END;
+    CREATE TRIGGER site_changes_ad AFTER DELETE ON sites BEGIN
+        INSERT OR REPLACE INTO site_changes (site_id, seq, deleted)
+        VALUES (old.id, (SELECT COALESCE(MAX(seq), 0) + 1 FROM site_changes), 1);
+    END;
+    INSERT INTO site_changes (site_id, seq) SELECT id, ROW_NUMBER() OVER (ORDER BY id) FROM sites;
+'''
+
+# Perceptual hashes of stored images for duplicate detection (dedupe.py).
+# Keyed by path like media: stored files never change, so each one is hashed
+# once however many sites use it.
+HASHES_SCHEMA = '''
+    CREATE TABLE image_hashes (path TEXT PRIMARY KEY, phash INTEGER NOT NULL) WITHOUT ROWID
+'''
+
+
+def _table_exists(conn, name):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def _create_sites(conn):
+    db.run_script(conn, SITES_SCHEMA)
+
+
+# init_db() used to create heritage_sites while the app read and wrote sites;
+# fold any rows it holds into sites
+def _merge_heritage_sites(conn):
+    if _table_exists(conn, 'heritage_sites'):
+        db.run_script(conn, LEGACY_MERGE)
+        if _table_exists(conn, 'site_clusters'):
+            clusters.rebuild(conn)
+
+
+def _create_if_missing(table, script):
+    def step(conn):
+        if not _table_exists(conn, table):
+            db.run_script(conn, script)
+    return step
+
+
+def _create_imports(conn):
+    db.run_script(conn, IMPORTS_SCHEMA)
+
+
+def _create_indexes(conn):
+    db.run_script(conn, ACCESS_PATH_INDEXES)
+
+
+MIGRATIONS = [
+    (1, _create_sites),
+    (2, _merge_heritage_sites),
+    (3, _create_if_missing('sites_fts', SEARCH_SCHEMA)),
+    (4, _create_if_missing('sites_rtree', SPATIAL_SCHEMA)),
+    (5, _create_if_missing('media', MEDIA_SCHEMA)),
+    (6, clusters.ensure_clusters),
+    (7, _create_imports),
+    (8, _create_indexes),
+    (9, _create_if_missing('site_changes', CHANGES_SCHEMA)),
+    (10, _create_if_missing('image_hashes', HASHES_SCHEMA)),
+    (11, clusters.install_triggers),
+    (12, clusters.replace_triggers),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Bring the database up to LATEST_VERSION; a no-op once it is current
+def migrate(conn):
+    version = schema_version(conn)
+    for target, step in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have applied it while we waited for the lock
+            if schema_version(conn) >= target:
+                conn.rollback()
+                version = schema_version(conn)
+                continue
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        version = target
+    return version
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate the Sthalaspurti database")
+    parser.add_argument('database', nargs='?', default=db.DB_PATH)
+    args = parser.parse_args()
+    conn = db.connect(args.database)
+    before = schema_version(conn)
+    after = migrate(conn)
+    print(f"{args.database}: schema version {before} -> {after}")
@@ -0,0 +1,229 @@
+import mimetypes
+import os
+import re
+import threading
+import time
+from flask import Flask, Response, g, jsonify, request, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+import clusters
+import db
+import media
+import metrics
+import migrations
+from config import API_HOST, API_PORT, UPLOAD_FOLDER, DERIVATIVE_SIZES, USE_X_SENDFILE
+
+MAX_SITES = 2000
+UPLOAD_ROOT = os.path.abspath(UPLOAD_FOLDER)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# ab/cd/<sha256>.<ext> names from storage.content_path()
+CONTENT_ADDRESSED = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.\w+)?$')
+# image_<uuid>.<ext> and audio_<uuid>.<ext> names from before the store
+LEGACY_UPLOAD = re.compile(r'^(?:image|audio)_[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12}\.\w+$')
+# Optional compressed copies stored next to an upload, best first
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+flask_app = Flask(__name__)
+# Hand file bodies to a fronting nginx/Apache instead of copying them in Python
+flask_app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+# The shared database, migrated on first use so the server also works on its
+# own (python server.py or gunicorn) against a fresh or older heritage.db
+def get_database():
+    global _schema_ready
+    database = db.get_database()
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                with database.writer() as conn:
+                    migrations.migrate(conn)
+                _schema_ready = True
+    return database
+
+
+@flask_app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+# The map runs inside a Streamlit component iframe on another origin
+@flask_app.after_request
+def allow_cross_origin(response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+# Latency per route rather than per URL, so tiles and uploads stay a handful
+# of series
+@flask_app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unmatched'
+    if 'request_start' in g:
+        metrics.record_span('http', endpoint, time.perf_counter() - g.request_start)
+    metrics.inc('sthalaspurti_http_requests_total', "HTTP requests by route and status",
+                endpoint=endpoint, status=response.status_code)
+    return response
+
+
+def _error(message, status):
+    return {"success": False, "message": message}, status
+
+
+def _parse_bbox(value):
+    west, south, east, north = (float(v) for v in value.split(','))
+    if not (-90 <= south <= north <= 90):
+        raise ValueError
+    west = max(-180.0, min(180.0, west))
+    east = max(-180.0, min(180.0, east))
+    return west, south, east, north
+
+
+def _site_json(site):
+    return {key: site[key] for key in ('id', 'title', 'description', 'image', 'audio', 'lat', 'lng')}
+
+
+def _site_feature(site):
+    properties = {key: site[key] for key in ('id', 'title', 'description', 'image', 'audio')}
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [site['lng'], site['lat']]},
+        "properties": properties,
+    }
+
+
+# Sites visible in a map viewport.
+# ?bbox=west,south,east,north&zoom=12&limit=500&format=json|geojson
+@flask_app.route('/sites')
+def sites():
+    try:
+        bbox = _parse_bbox(request.args.get('bbox', '-180,-90,180,90'))
+    except ValueError:
+        return _error("bbox must be west,south,east,north in degrees", 400)
+    zoom = request.args.get('zoom', type=int)
+    if zoom is not None:
+        zoom = max(0, min(22, zoom))
+    limit = max(1, min(MAX_SITES, request.args.get('limit', 500, type=int)))
+
+    with get_database().reader() as conn:
+        rows = db.sites_in_bbox(conn, *bbox, zoom=zoom, limit=limit)
+
+    if request.args.get('format') == 'geojson':
+        return jsonify({"type": "FeatureCollection", "features": [_site_feature(r) for r in rows]})
+    return jsonify([_site_json(r) for r in rows])
+
+
+def _sync_json(site):
+    return {key: site[key] for key in db.SYNC_COLUMNS.split(', ')}
+
+
+# Incremental sync for clients that keep their own copy of the collection.
+# ?since=<cursor>&limit=1000: start from 0 (or the cursor printed by
+# export.py), then pass back the returned cursor until `more` is false.
+@flask_app.route('/sites/changes')
+def site_changes():
+    since = max(0, request.args.get('since', 0, type=int))
+    limit = max(1, min(MAX_SITES, request.args.get('limit', 1000, type=int)))
+    with get_database().reader() as conn:
+        rows = db.fetch_changes(conn, since, limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        "sites": [_sync_json(r) for r in rows if not r['deleted']],
+        "deleted": [r['id'] for r in rows if r['deleted']],
+        "cursor": rows[-1]['seq'] if rows else since,
+        "more": more,
+    })
+
+
+# Precomputed clusters for one map tile. Past the deepest cluster level the
+# tile holds individual sites, thinned to one per cell like /sites.
+@flask_app.route('/tiles/<int:z>/<int:x>/<int:y>.json')
+def site_tile(z, x, y):
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return _error("Tile out of range", 404)
+    with get_database().reader() as conn:
+        if z <= clusters.MAX_CLUSTER_ZOOM:
+            features = clusters.tile(conn, z, x, y)
+        else:
+            rows = db.sites_in_bbox(conn, *clusters.tile_bounds(z, x, y), zoom=z,
+                                    limit=clusters.CELLS_PER_TILE ** 2 * 4)
+            features = [dict(_site_json(r), count=1) for r in rows]
+    return jsonify(features)
+
+
+# Send an upload with validators for conditional and Range requests. Stored
+# names never change content, so they can be cached forever; content-addressed
+# ones use their hash as a strong ETag that holds across servers.
+def _send_upload(path, etag, immutable):
+    directory, name = os.path.split(path)
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    encoding = None
+    for candidate, suffix in PRECOMPRESSED:
+        if request.accept_encodings[candidate] and os.path.isfile(path + suffix):
+            encoding, name = candidate, name + suffix
+            etag = f"{etag}-{candidate}" if etag else True
+            break
+    response = send_from_directory(directory, name, mimetype=mimetype, conditional=True,
+                                   etag=etag or True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+# Stored uploads. ?size= picks one of the derivative sizes for images; the
+# original is served, revalidated rather than cached, until that derivative
+# has been generated.
+@flask_app.route('/Uploads/<path:filename>')
+def uploaded_file(filename):
+    size = request.args.get('size', type=int)
+    if size is not None and size not in DERIVATIVE_SIZES:
+        return _error("Unknown image size", 404)
+    # Only stored uploads: never .incoming/ temp files or other dot entries
+    match = CONTENT_ADDRESSED.match(filename)
+    if any(part.startswith('.') for part in filename.split('/')) \
+            or not (match or LEGACY_UPLOAD.match(filename)):
+        return _error("File not found", 404)
+    original = safe_join(UPLOAD_ROOT, filename)
+    if original is None:
+        return _error("File not found", 404)
+    etag = match.group(1) if match else None
+    path, immutable = original, True
+    if size is not None:
+        path = media.image_path(filename, size, UPLOAD_ROOT)
+        if path != original:
+            etag = f"{etag}-{size}" if etag else None
+        else:
+            immutable = False
+    try:
+        return _send_upload(path, etag, immutable)
+    except NotFound:
+        return _error("File not found", 404)
+
+
+# Counters and latency histograms in the Prometheus text format
+@flask_app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Development server, one thread per request. In production run the app
+# under a threaded WSGI server whose file wrapper uses sendfile, e.g.
+#   gunicorn -k gthread --threads 16 -b :5001 server:flask_app
+def run():
+    flask_app.run(host=API_HOST, port=API_PORT, threaded=True)
+
+
+if __name__ == '__main__':
+    run()
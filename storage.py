@@ -0,0 +1,192 @@
+import argparse
+import base64
+import hashlib
+import os
+import tempfile
+import time
+import db
+import media
+import metrics
+import migrations
+from config import UPLOAD_FOLDER, ALLOWED_EXTENSIONS, MAX_FILE_SIZE, DERIVED_FOLDER, DERIVATIVE_SIZES, GC_GRACE_SECONDS
+
+# Uploads are stored under their SHA-256, fanned out as ab/cd/abcd....ext so
+# no directory grows too large and the same bytes are only ever kept once.
+# The media table counts how many site rows point at each file.
+CHUNK_SIZE = 64 * 1024
+INCOMING_FOLDER = '.incoming'
+# Leading bytes of each allowed type, so a file's real format is checked
+# rather than taken from its name
+SIGNATURES = {
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'gif': (b'GIF87a', b'GIF89a'),
+    'webm': (b'\x1a\x45\xdf\xa3',),
+}
+
+
+# Check allowed file extensions
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def matches_signature(head, ext):
+    return head.startswith(SIGNATURES.get(ext, ()))
+
+
+def content_path(digest, ext):
+    name = f"{digest}.{ext}" if ext else digest
+    return f"{digest[:2]}/{digest[2:4]}/{name}"
+
+
+# Copy an iterable of byte chunks into the store, hashing as it goes, so
+# memory use is bounded by the chunk size rather than the file size.
+# Returns the stored path relative to the upload folder and whether the
+# content was new.
+@metrics.timed('file')
+def store_chunks(chunks, ext, max_size=None, upload_folder=UPLOAD_FOLDER):
+    incoming = os.path.join(upload_folder, INCOMING_FOLDER)
+    os.makedirs(incoming, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=incoming)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise ValueError(f"File size exceeds {max_size // (1024 * 1024)}MB limit")
+                digest.update(chunk)
+                f.write(chunk)
+        path = content_path(digest.hexdigest(), ext)
+        final_path = os.path.join(upload_folder, path)
+        try:
+            # Reusing a stored file restarts its garbage collection grace period
+            os.utime(final_path)
+            os.remove(tmp_path)
+            return path, False
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, final_path)
+        return path, True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# SHA-256 of a file object, read a chunk at a time and rewound afterwards
+def file_digest(file):
+    file.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def store_file(file, ext, max_size=None, upload_folder=UPLOAD_FOLDER):
+    return store_chunks(iter(lambda: file.read(CHUNK_SIZE), b''), ext, max_size, upload_folder)
+
+
+# Save uploaded file into the content-addressed store
+def save_file(file, upload_folder=UPLOAD_FOLDER):
+    try:
+        if file.size > MAX_FILE_SIZE:
+            return None, "File size exceeds 5MB limit"
+        ext = file.name.rsplit('.', 1)[1].lower() if '.' in file.name else ''
+        if not allowed_file(file.name):
+            return None, "Invalid file type. Use PNG, JPG, JPEG, GIF, or WebM"
+        file.seek(0)
+        if not matches_signature(file.read(16), ext):
+            return None, f"File is not a valid {ext.upper()} file"
+        file.seek(0)
+        filename, _ = store_file(file, ext, max_size=MAX_FILE_SIZE, upload_folder=upload_folder)
+        return filename, None
+    except Exception as e:
+        return None, f"Error saving file: {e}"
+
+
+# Decode a base64 payload a slice at a time instead of all at once
+def base64_chunks(data, start=0, chunk_size=CHUNK_SIZE):
+    step = chunk_size // 3 * 4
+    for offset in range(start, len(data), step):
+        yield base64.b64decode(data[offset:offset + step])
+
+
+def store_data_url(data_url, ext, max_size=None, upload_folder=UPLOAD_FOLDER):
+    payload_start = data_url.index(',') + 1
+    return store_chunks(base64_chunks(data_url, payload_start), ext, max_size, upload_folder)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Delete a stored file unless it was touched after `cutoff`. An upload that
+# reuses the file refreshes its mtime (store_chunks) without any database
+# lock, so the file is first moved aside and its mtime checked again: a
+# refresh that landed before the move shows up on the moved file, and one
+# after it finds no file and stores a fresh copy. Returns False if kept.
+def _remove_untouched(upload_folder, path, cutoff):
+    stored = os.path.join(upload_folder, path)
+    try:
+        seen = os.stat(stored).st_mtime_ns
+    except FileNotFoundError:
+        return True
+    if seen > cutoff * 1e9:
+        return False
+    incoming = os.path.join(upload_folder, INCOMING_FOLDER)
+    os.makedirs(incoming, exist_ok=True)
+    tombstone = os.path.join(incoming, 'gc-' + os.path.basename(path))
+    try:
+        os.replace(stored, tombstone)
+    except FileNotFoundError:
+        return True
+    if os.stat(tombstone).st_mtime_ns != seen:
+        os.replace(tombstone, stored)
+        return False
+    os.remove(tombstone)
+    return True
+
+
+# Delete stored files, and their derived copies, that no site refers to any
+# more. Each file is rechecked under the database write lock, and files
+# touched within the grace period are kept: an upload that reuses one
+# refreshes its mtime before inserting the site that will reference it.
+def collect_garbage(conn, upload_folder=UPLOAD_FOLDER, grace=GC_GRACE_SECONDS):
+    removed = 0
+    for (path,) in conn.execute('SELECT path FROM media WHERE refs <= 0').fetchall():
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            unused = conn.execute('SELECT 1 FROM media WHERE path = ? AND refs <= 0', (path,)).fetchone()
+            if not unused or not _remove_untouched(upload_folder, path, time.time() - grace):
+                continue
+            if media.is_image(path):
+                for size in DERIVATIVE_SIZES:
+                    _remove(os.path.join(upload_folder, DERIVED_FOLDER, media.derivative_name(path, size)))
+            conn.execute('DELETE FROM media WHERE path = ?', (path,))
+            conn.execute('DELETE FROM image_hashes WHERE path = ?', (path,))
+        removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sthalaspurti upload store tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    gc_parser = commands.add_parser('gc', help="delete uploads no site refers to")
+    gc_parser.add_argument('--uploads', default=UPLOAD_FOLDER)
+    gc_parser.add_argument('--grace', type=float, default=GC_GRACE_SECONDS,
+                           help="keep files touched within this many seconds")
+    args = parser.parse_args()
+    if args.command == 'gc':
+        conn = db.connect()
+        migrations.migrate(conn)
+        print(f"{collect_garbage(conn, args.uploads, args.grace)} unreferenced files removed")
+        conn.close()